@@ -0,0 +1,94 @@
+"""
+Measures peak memory of the collection walks (check_file_names, get_package_names, check_uri_txt,
+get_collection_file_counts) on synthetic collections of growing size (run from the repo root)
+Each measurement is a fresh interpreter; peak python allocations (tracemalloc) should stay flat as files grow
+The sftp upload-status walk needs a live sftp server and is not covered
+
+usage: python3 bench/memory.py [file counts...]
+"""
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from os.path import abspath, dirname
+
+root = dirname(dirname(abspath(__file__)))
+sizes = [int(size) for size in sys.argv[1:]] or [10000, 40000, 160000]
+packages = 10
+operations = ['check_file_names', 'get_package_names', 'check_uri_txt', 'get_collection_file_counts']
+
+# Runs inside the child interpreter and prints its peak memory as json
+child = '''
+import json, resource, sys, tracemalloc
+import qa_lib
+operation = sys.argv[1]
+tracemalloc.start()
+if operation == 'check_file_names':
+    qa_lib.check_file_names('collection', True)
+elif operation == 'get_package_names':
+    sum(1 for package in qa_lib.get_package_names('collection'))
+else:
+    getattr(qa_lib, operation)('collection')
+print(json.dumps(dict(peak=tracemalloc.get_traced_memory()[1],
+                      max_rss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)))
+'''
+
+
+def create_collection(path, file_count):
+    """
+    Creates a collection with empty files spread over packages (one name in a thousand needs a rename)
+    @param: path
+    @param: file_count
+    @returns: void
+    """
+
+    for i in range(packages):
+
+        package = os.path.join(path, 'collection', 'package_' + str(i))
+        os.makedirs(package)
+
+        with open(os.path.join(package, 'uri.txt'), 'w') as uri_txt:
+            uri_txt.write('/repositories/2/archival_objects/' + str(i))
+
+        for j in range(file_count // packages - 1):
+            name = 'File ' + str(j) if j % 1000 == 0 else 'file_' + str(j) + '.tif'
+            open(os.path.join(package, name), 'w').close()
+
+
+def run_once(path, operation):
+    """
+    Runs an operation in a new interpreter and gets its peak memory
+    @param: path
+    @param: operation
+    @returns: Dictionary
+    """
+
+    env = dict(os.environ, READY_PATH=path + '/', ERRORS_FILE=os.path.join(path, 'errors.txt'),
+               TRACE_FILE=os.path.join(path, 'traces.json'))
+    output = subprocess.run([sys.executable, '-c', child, operation], cwd=root, env=env, capture_output=True,
+                            text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    """
+    Runs the memory benchmark and prints peak memory per operation and collection size
+    @returns: void
+    """
+
+    print('files'.ljust(10) + 'operation'.ljust(30) + 'peak python (KiB)'.ljust(20) + 'max rss (KiB)')
+
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as path:
+            create_collection(path, size)
+
+            for operation in operations:
+                result = run_once(path, operation)
+                print(str(size).ljust(10) + operation.ljust(30) + str(result['peak'] // 1024).ljust(20) +
+                      str(result['max_rss']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""
+Measures qa.py startup: module import, create_app() and the first request (run from the repo root)
+Each run is a fresh interpreter so nothing is cached between runs
+
+usage: python3 bench/startup.py [runs]
+"""
+
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from os.path import abspath, dirname
+
+root = dirname(dirname(abspath(__file__)))
+runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+
+# Runs inside the child interpreter and prints its timings as json
+child = '''
+import json, sys, time
+start = time.perf_counter()
+import qa
+imported = time.perf_counter()
+app = qa.create_app()
+created = time.perf_counter()
+response = app.test_client().get('/api/v2/qa/list-ready-folders?api_key=bench')
+first_request = time.perf_counter()
+print(json.dumps(dict(import_time=imported - start, create_app=created - imported,
+                      first_request=first_request - created, status=response.status_code,
+                      sftp_imported='pysftp' in sys.modules or 'paramiko' in sys.modules)))
+'''
+
+
+def run_once(ready):
+    """
+    Starts qa.py in a new interpreter and gets its startup timings
+    @param: ready
+    @returns: Dictionary
+    """
+
+    env = dict(os.environ, API_KEY='bench', READY_PATH=ready + '/')
+    output = subprocess.run([sys.executable, '-c', child], cwd=root, env=env, capture_output=True, text=True,
+                            check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    """
+    Runs the startup benchmark and prints median/max timings
+    @returns: void
+    """
+
+    with tempfile.TemporaryDirectory() as ready:
+        results = [run_once(ready) for _ in range(runs)]
+
+    print('runs: ' + str(runs))
+
+    for key in ('import_time', 'create_app', 'first_request'):
+        values = [result[key] for result in results]
+        print(key + ': median ' + format(statistics.median(values), '.3f') + 's, max ' +
+              format(max(values), '.3f') + 's')
+
+    print('first request status: ' + str(results[0]['status']))
+    print('pysftp/paramiko imported at startup: ' + str(any(result['sftp_imported'] for result in results)))
+
+
+if __name__ == '__main__':
+    main()
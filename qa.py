@@ -1,11 +1,19 @@
+import time
+
+startup_time = time.perf_counter()
+
+import cProfile
+import io
 import json
 import os
+import pstats
+import random
+import threading
 
 from os.path import join, dirname
 from dotenv import load_dotenv
-from flask import Flask, request
+from flask import Blueprint, Flask, Response, g, request, stream_with_context
 from flask_cors import CORS
-from waitress import serve
 
 import qa_lib
 
@@ -15,24 +23,161 @@ load_dotenv(dotenv_path)
 ready_path = os.getenv('READY_PATH')
 batch_size_limit = os.getenv('BATCH_SIZE_LIMIT')
 app_version = os.getenv('APP_VERSION')
-export_aws_default_profile = 'export AWS_DEFAULT_PROFILE=' + os.getenv('AWS_DEFAULT_PROFILE')
-export_aws_access_key_id = 'export AWS_ACCESS_KEY_ID=' + os.getenv('AWS_ACCESS_KEY_ID')
-export_aws_secret_access_key = 'export AWS_SECRET_ACCESS_KEY=' + os.getenv('AWS_SECRET_ACCESS_KEY')
-export_aws_default_region = 'export AWS_DEFAULT_REGION=' + os.getenv('AWS_DEFAULT_REGION')
-os.system(export_aws_default_profile)
-os.system(export_aws_access_key_id)
-os.system(export_aws_secret_access_key)
-os.system(export_aws_default_region)
-os.system('printenv')
-
-app = Flask(__name__)
-cors = CORS(app, resources={r"/api/*": {"origins": "*"}})
+profile_path = os.getenv('PROFILE_PATH', 'profiles')
+profile_key = os.getenv('PROFILE_KEY')
+profile_sample_rate = float(os.getenv('PROFILE_SAMPLE_RATE', '0'))
+profile_keep = int(os.getenv('PROFILE_KEEP', '50'))
+app_threads = int(os.getenv('APP_THREADS', '16'))
+# each progress stream holds a waitress thread, the rest are kept for other requests
+progress_streams = threading.BoundedSemaphore(int(os.getenv('PROGRESS_STREAMS_MAX', str(app_threads // 2))))
+aws_variables = ['AWS_DEFAULT_PROFILE', 'AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY', 'AWS_DEFAULT_REGION']
+
+api = Blueprint('qa', __name__)
 prefix = '/api/'
 version = 'v2'
 endpoint = '/qa/'
+timings = dict(first_request=None)
+
+
+def create_app():
+    """
+    Creates QA application (pysftp/paramiko are only imported when a route needs them)
+    @returns: Flask
+    """
+
+    configure_environment()
+
+    app = Flask(__name__)
+    CORS(app, resources={r"/api/*": {"origins": "*"}})
+    app.register_blueprint(api)
+    app.debug = True
+
+    @app.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+        qa_lib.set_trace_batch(request.args.get('uuid'))
+
+    @app.after_request
+    def log_first_request(response):
+
+        if timings['first_request'] is None:
+            timings['first_request'] = time.perf_counter() - g.request_start
+            print('Startup: first request took ' + format(timings['first_request'], '.3f') + 's')
+
+        return response
+
+    app.before_request(start_profiler)
+    app.after_request(save_profile)
+
+    # batches transferred by workers keep publishing progress after a restart
+    qa_lib.resume_batch_watchers()
+
+    print('Startup: import and app creation took ' + format(time.perf_counter() - startup_time, '.3f') + 's')
+
+    return app
+
+
+def configure_environment():
+    """
+    Checks that the AWS settings loaded from .env are in the process environment
+    (the aws cli inherits them when it is run by qa_lib)
+    @returns: void
+    """
+
+    for variable in aws_variables:
+        if os.getenv(variable) is None:
+            print('WARNING: ' + variable + ' is not set')
+
+
+def start_profiler():
+    """
+    Starts profiling a request when the X-Profile-Key header matches PROFILE_KEY
+    or the request is sampled (PROFILE_SAMPLE_RATE)
+    @returns: void
+    """
+
+    # request threads are reused, drop thread profiling left by a request that ended without save_profile
+    qa_lib.stop_thread_profiling()
+    is_requested = bool(profile_key) and request.headers.get('X-Profile-Key') == profile_key
+
+    if not is_requested and random.random() >= profile_sample_rate:
+        return
+
+    profiler = cProfile.Profile()
+
+    try:
+        profiler.enable()
+    except ValueError as e:  # another profiler is already active
+        print(e)
+        return
+
+    g.profiler = profiler
+    g.thread_profiles = qa_lib.start_thread_profiling()
+    g.profile_wall = time.perf_counter()
+    g.profile_cpu = time.thread_time()
+    g.profile_process_cpu = time.process_time()
+
+
+def save_profile(response):
+    """
+    Saves call tree, wall time and cpu time of a profiled request to PROFILE_PATH
+    (pool and writer threads started by the request are merged into the call tree,
+    only the newest PROFILE_KEEP profiles are kept)
+    @param: response
+    @returns: response
+    """
+
+    profiler = g.pop('profiler', None)
+
+    if profiler is None:
+        return response
+
+    profiler.disable()
+    qa_lib.stop_thread_profiling()
+    thread_profiles = g.pop('thread_profiles', [])
+    wall_time = time.perf_counter() - g.profile_wall
+    cpu_time = time.thread_time() - g.profile_cpu
+    process_cpu_time = time.process_time() - g.profile_process_cpu
+    name = time.strftime('%Y%m%d-%H%M%S') + '-' + str(request.endpoint) + '-' + os.urandom(4).hex()
+    args = dict((key, value) for key, value in request.args.items() if key != 'api_key')
+
+    try:
+        os.makedirs(profile_path, exist_ok=True)
+        report = io.StringIO()
+        stats = pstats.Stats(profiler, stream=report)
+
+        for thread_profile in thread_profiles:
+            stats.add(thread_profile)
+
+        stats.dump_stats(os.path.join(profile_path, name + '.prof'))
+        report.write(request.method + ' ' + request.path + ' ' + json.dumps(args) + '\n')
+        report.write('wall time: ' + format(wall_time, '.3f') + 's\n')
+        report.write('cpu time (request thread): ' + format(cpu_time, '.3f') + 's\n')
+        report.write('cpu time (process): ' + format(process_cpu_time, '.3f') + 's\n')
+        report.write('profiled threads: ' + str(len(thread_profiles) + 1) + '\n\n')
+        stats.sort_stats('cumulative')
+        stats.print_stats(50)
+        stats.print_callees(50)
+
+        with open(os.path.join(profile_path, name + '.txt'), 'w') as report_file:
+            report_file.write(report.getvalue())
+
+        profiles = sorted((f for f in os.listdir(profile_path) if f.endswith('.prof')),
+                          key=lambda f: os.path.getmtime(os.path.join(profile_path, f)))
+
+        for f in profiles[:-profile_keep]:
+            os.remove(os.path.join(profile_path, f))
+            os.remove(os.path.join(profile_path, f[:-len('.prof')] + '.txt'))
+
+        response.headers['X-Profile'] = name
+    except Exception as e:
+        print(e)
+        print('ERROR: Unable to save profile - ' + name)
+
+    return response
 
 
-@app.route('/', methods=['GET'])
+@api.route('/', methods=['GET'])
 def index():
     """
     Renders QA API Information
@@ -42,7 +187,7 @@ def index():
     return 'DigitalDU-QA ' + app_version
 
 
-@app.route(prefix + version + endpoint + 'list-ready-folders', methods=['GET'])
+@api.route(prefix + version + endpoint + 'list-ready-folders', methods=['GET'])
 def list_ready_folders():
     """"
     Gets a list of ready folders
@@ -66,7 +211,7 @@ def list_ready_folders():
     return json.dumps(ready_list), 200
 
 
-@app.route(prefix + version + endpoint + 'set-collection-folder', methods=['GET'])
+@api.route(prefix + version + endpoint + 'set-collection-folder', methods=['GET'])
 def set_collection_folder_name():
     """
     Runs QA process to set collection folder name (saves name to txt file)
@@ -95,7 +240,7 @@ def set_collection_folder_name():
     return json.dumps(dict(is_set=is_set)), 200
 
 
-@app.route(prefix + version + endpoint + 'check-collection-folder', methods=['GET'])
+@api.route(prefix + version + endpoint + 'check-collection-folder', methods=['GET'])
 def check_collection_folder_name():
     """
     Runs QA process to check collection folder name (checks folder nomenclature)
@@ -126,7 +271,7 @@ def check_collection_folder_name():
     return json.dumps(results), 200
 
 
-@app.route(prefix + version + endpoint + 'package-names', methods=['GET'])
+@api.route(prefix + version + endpoint + 'package-names', methods=['GET'])
 def get_package_names():
     """
     Get package names
@@ -151,22 +296,36 @@ def get_package_names():
         return json.dumps(['Bad Request: Missing folder param']), 400
 
     packages = qa_lib.get_package_names(folder)
-    results = dict(packages=packages)
+    # Read the first name before streaming so that a missing folder still fails before the response starts
+    first = next(packages, None)
 
-    return json.dumps(results), 200
+    def stream():
+        yield '{"packages": ['
+
+        if first is not None:
+            yield json.dumps(first)
+
+            for package in packages:
+                yield ', ' + json.dumps(package)
 
+        yield ']}'
 
-@app.route(prefix + version + endpoint + 'check-package-names', methods=['GET'])
+    return Response(stream_with_context(stream()), mimetype='application/json')
+
+
+@api.route(prefix + version + endpoint + 'check-package-names', methods=['GET'])
 def check_package_names():
     """
     Runs QA process to checks package names (checks package name nomenclature)
     @param: api_key
     @param: folder
+    @param: dry_run
     @returns: Json
     """
 
     api_key = request.args.get('api_key')
     folder = request.args.get('folder')
+    dry_run = request.args.get('dry_run') == 'true'
     errors = []
 
     if api_key is None:
@@ -180,24 +339,26 @@ def check_package_names():
     if folder is None:
         return json.dumps(['Bad Request: Missing folder param']), 400
 
-    package_name_results = qa_lib.check_package_names(folder)
+    package_name_results = qa_lib.check_package_names(folder, dry_run)
 
     results = dict(package_name_results=package_name_results)
 
     return json.dumps(results), 200
 
 
-@app.route(prefix + version + endpoint + 'check-file-names', methods=['GET'])
+@api.route(prefix + version + endpoint + 'check-file-names', methods=['GET'])
 def check_file_names():
     """
     Runs QA process to check file names
     @param: api_key
     @param: folder
+    @param: dry_run
     @returns: Json
     """
 
     api_key = request.args.get('api_key')
     folder = request.args.get('folder')
+    dry_run = request.args.get('dry_run') == 'true'
     errors = []
 
     if api_key is None:
@@ -211,14 +372,14 @@ def check_file_names():
     if folder is None:
         return json.dumps(['Bad Request: Missing folder param']), 400
 
-    file_count_results = qa_lib.check_file_names(folder)
+    file_count_results = qa_lib.check_file_names(folder, dry_run)
 
     results = dict(file_count_results=file_count_results)
 
     return json.dumps(results), 200
 
 
-@app.route(prefix + version + endpoint + 'check-uri-txt', methods=['GET'])
+@api.route(prefix + version + endpoint + 'check-uri-txt', methods=['GET'])
 def check_uri_txt():
     """
     Runs QA process to check uri.txt
@@ -249,7 +410,100 @@ def check_uri_txt():
     return json.dumps(results), 200
 
 
-@app.route(prefix + version + endpoint + 'get-uri-txt', methods=['GET'])
+@api.route(prefix + version + endpoint + 'check-file-formats', methods=['GET'])
+def check_file_formats():
+    """
+    Runs QA process to check file formats (extension vs content, empty files)
+    @param: api_key
+    @param: folder
+    @returns: Json
+    """
+
+    api_key = request.args.get('api_key')
+    folder = request.args.get('folder')
+    errors = []
+
+    if api_key is None:
+        errors.append('Access denied.')
+    elif api_key != os.getenv('API_KEY'):
+        errors.append('Access denied.')
+
+    if len(errors) > 0:
+        return json.dumps(errors), 403
+
+    if folder is None:
+        return json.dumps(['Bad Request: Missing folder param']), 400
+
+    file_format_results = qa_lib.check_file_formats(folder)
+
+    results = dict(file_format_results=file_format_results)
+
+    return json.dumps(results), 200
+
+
+@api.route(prefix + version + endpoint + 'check-duplicates', methods=['GET'])
+def check_duplicates():
+    """
+    Runs QA process to check for files and packages that were already ingested
+    @param: api_key
+    @param: folder
+    @returns: Json
+    """
+
+    api_key = request.args.get('api_key')
+    folder = request.args.get('folder')
+    errors = []
+
+    if api_key is None:
+        errors.append('Access denied.')
+    elif api_key != os.getenv('API_KEY'):
+        errors.append('Access denied.')
+
+    if len(errors) > 0:
+        return json.dumps(errors), 403
+
+    if folder is None:
+        return json.dumps(['Bad Request: Missing folder param']), 400
+
+    duplicate_results = qa_lib.check_duplicates(folder)
+
+    results = dict(duplicate_results=duplicate_results)
+
+    return json.dumps(results), 200
+
+
+@api.route(prefix + version + endpoint + 'check-ingested', methods=['GET'])
+def check_ingested():
+    """
+    Runs QA process to check which packages were already ingested
+    @param: api_key
+    @param: folder
+    @returns: Json
+    """
+
+    api_key = request.args.get('api_key')
+    folder = request.args.get('folder')
+    errors = []
+
+    if api_key is None:
+        errors.append('Access denied.')
+    elif api_key != os.getenv('API_KEY'):
+        errors.append('Access denied.')
+
+    if len(errors) > 0:
+        return json.dumps(errors), 403
+
+    if folder is None:
+        return json.dumps(['Bad Request: Missing folder param']), 400
+
+    ingested_results = qa_lib.check_ingested(folder)
+
+    results = dict(ingested_results=ingested_results)
+
+    return json.dumps(results), 200
+
+
+@api.route(prefix + version + endpoint + 'get-uri-txt', methods=['GET'])
 def get_uri_txt():
     """
     Runs QA process to get uri.txt
@@ -284,7 +538,38 @@ def get_uri_txt():
     return json.dumps(results), 200
 
 
-@app.route(prefix + version + endpoint + 'get-total-batch-size', methods=['GET'])
+@api.route(prefix + version + endpoint + 'get-uri-txts', methods=['GET'])
+def get_uri_txts():
+    """
+    Runs QA process to get and check uri.txt of every package in a collection
+    @param: api_key
+    @param: folder
+    @returns: Json
+    """
+
+    api_key = request.args.get('api_key')
+    folder = request.args.get('folder')
+    errors = []
+
+    if api_key is None:
+        errors.append('Access denied.')
+    elif api_key != os.getenv('API_KEY'):
+        errors.append('Access denied.')
+
+    if len(errors) > 0:
+        return json.dumps(errors), 403
+
+    if folder is None:
+        return json.dumps(['Bad Request: Missing folder param']), 400
+
+    uris = qa_lib.get_uri_txts(folder)
+
+    results = dict(uri_results=uris)
+
+    return json.dumps(results), 200
+
+
+@api.route(prefix + version + endpoint + 'get-total-batch-size', methods=['GET'])
 def get_total_batch_size():
     """
     Runs QA process to get batch size
@@ -315,7 +600,7 @@ def get_total_batch_size():
     return json.dumps(results), 200
 
 
-@app.route(prefix + version + endpoint + 'package-file-count', methods=['GET'])
+@api.route(prefix + version + endpoint + 'package-file-count', methods=['GET'])
 def get_package_file_count():
     """
     Runs QA process to package file count
@@ -350,7 +635,69 @@ def get_package_file_count():
         return json.dumps(results), 200
 
 
-@app.route(prefix + version + endpoint + 'move-to-ingest', methods=['GET'])
+@api.route(prefix + version + endpoint + 'collection-file-count', methods=['GET'])
+def get_collection_file_counts():
+    """
+    Runs QA process to get file count of every package in a collection and the batch total
+    @param: api_key
+    @param: folder
+    @returns: Json
+    """
+
+    api_key = request.args.get('api_key')
+    folder = request.args.get('folder')
+    errors = []
+
+    if api_key is None:
+        errors.append('Access denied.')
+    elif api_key != os.getenv('API_KEY'):
+        errors.append('Access denied.')
+
+    if len(errors) > 0:
+        return json.dumps(errors), 403
+
+    if folder is None:
+        return json.dumps(['Bad Request: Missing folder param']), 400
+
+    file_counts = qa_lib.get_collection_file_counts(folder)
+
+    results = dict(file_count_results=file_counts)
+
+    return json.dumps(results), 200
+
+
+@api.route(prefix + version + endpoint + 'preflight', methods=['GET'])
+def preflight():
+    """
+    Predicts transfer duration of a collection and checks free space before it is moved
+    @param: api_key
+    @param: folder
+    @returns: Json
+    """
+
+    api_key = request.args.get('api_key')
+    folder = request.args.get('folder')
+    errors = []
+
+    if api_key is None:
+        errors.append('Access denied.')
+    elif api_key != os.getenv('API_KEY'):
+        errors.append('Access denied.')
+
+    if len(errors) > 0:
+        return json.dumps(errors), 403
+
+    if folder is None:
+        return json.dumps(['Bad Request: Missing folder param']), 400
+
+    preflight_results = qa_lib.preflight(folder)
+
+    results = dict(preflight_results=preflight_results)
+
+    return json.dumps(results), 200
+
+
+@api.route(prefix + version + endpoint + 'move-to-ingest', methods=['GET'])
 def move_to_ingest():
     """
     Moves packages to ingest folder
@@ -384,7 +731,7 @@ def move_to_ingest():
     return json.dumps(results), 200
 
 
-@app.route(prefix + version + endpoint + 'move-to-sftp', methods=['GET'])
+@api.route(prefix + version + endpoint + 'move-to-sftp', methods=['GET'])
 def move_to_sftp():
     """
     Uploads packages to Archivematica server
@@ -409,17 +756,22 @@ def move_to_sftp():
     if uuid is None:
         return json.dumps(['Bad Request: Missing pid param.']), 400
 
-    qa_lib.move_to_sftp(uuid)
+    results = qa_lib.move_to_sftp(uuid)
+
+    if len(results['errors']) > 0:
+        return json.dumps(results), 500
 
     return json.dumps(dict(message='Uploading packages to Archivematica sftp')), 200
 
 
-@app.route(prefix + version + endpoint + 'upload-status', methods=['GET'])
+@api.route(prefix + version + endpoint + 'upload-status', methods=['GET'])
 def check_sftp():
     """
     Checks upload status of packages on Archivematica sftp
+    (the server keeps batch file counts, total_batch_file_count is only used for batches it has no state for)
     @param: api_key
     @param: uuid
+    @param: total_batch_file_count
     @returns: Json
     """
 
@@ -439,14 +791,53 @@ def check_sftp():
     if uuid is None:
         return json.dumps(['Bad Request: Missing uuid param.']), 400
 
-    if total_batch_file_count is None:
-        return json.dumps(dict(message='File count not found.', data=[])), 200
-
     results = qa_lib.check_sftp(uuid, total_batch_file_count)
     return json.dumps(results), 200
 
 
-@app.route(prefix + version + endpoint + 'move-to-ingested', methods=['GET'])
+@api.route(prefix + version + endpoint + 'progress-events', methods=['GET'])
+def progress_events():
+    """
+    Pushes upload and job progress of a batch as server-sent events
+    (503 when PROGRESS_STREAMS_MAX streams are open, clients then poll upload-status)
+    @param: api_key
+    @param: uuid
+    @returns: Event stream
+    """
+
+    api_key = request.args.get('api_key')
+    uuid = request.args.get('uuid')
+    errors = []
+
+    if api_key is None:
+        errors.append('Access denied.')
+    elif api_key != os.getenv('API_KEY'):
+        errors.append('Access denied.')
+
+    if len(errors) > 0:
+        return json.dumps(errors), 403
+
+    if uuid is None:
+        return json.dumps(['Bad Request: Missing uuid param.']), 400
+
+    if not progress_streams.acquire(blocking=False):
+        return json.dumps(['Too many progress streams, use upload-status.']), 503, {'Retry-After': '30'}
+
+    def stream():
+        for event in qa_lib.get_progress_events(uuid):
+            if event is None:
+                yield ': keep-alive\n\n'
+            else:
+                yield 'data: ' + json.dumps(event) + '\n\n'
+
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    response = Response(stream_with_context(stream()), mimetype='text/event-stream', headers=headers)
+    response.call_on_close(progress_streams.release)
+
+    return response
+
+
+@api.route(prefix + version + endpoint + 'move-to-ingested', methods=['GET'])
 def move_to_ingested():
     """
     Move packages to ingested folder
@@ -473,11 +864,76 @@ def move_to_ingested():
     return json.dumps(results), 200
 
 
-@app.route(prefix + version + endpoint + 'reset_permissions', methods=['GET'])
+@api.route(prefix + version + endpoint + 'verify-s3', methods=['GET'])
+def verify_s3():
+    """
+    Verifies Wasabi S3 objects of a batch against its manifest
+    @param: api_key
+    @param: uuid
+    @returns: Json
+    """
+
+    api_key = request.args.get('api_key')
+    uuid = request.args.get('uuid')
+
+    if api_key is None:
+        return json.dumps(['Access denied.']), 403
+    elif api_key != os.getenv('API_KEY'):
+        return json.dumps(['Access denied.']), 403
+
+    if uuid is None:
+        return json.dumps(['Bad Request: Missing uuid param.']), 400
+
+    results = qa_lib.verify_s3(uuid)
+
+    return json.dumps(results), 200
+
+
+@api.route(prefix + version + endpoint + 'rebuild-ingested-index', methods=['GET'])
+def rebuild_ingested_index():
+    """
+    Adds collections and packages already in the ingested folder to the ingested index
+    @param: api_key
+    @returns: Json
+    """
+
+    api_key = request.args.get('api_key')
+
+    if api_key is None:
+        return json.dumps(['Access denied.']), 403
+    elif api_key != os.getenv('API_KEY'):
+        return json.dumps(['Access denied.']), 403
+
+    results = qa_lib.rebuild_ingested_index()
+
+    return json.dumps(results), 200
+
+
+@api.route(prefix + version + endpoint + 'rebuild-hash-index', methods=['GET'])
+def rebuild_hash_index():
+    """
+    Walks the ingested folder and updates the content hash index used by check-duplicates
+    @param: api_key
+    @returns: Json
+    """
+
+    api_key = request.args.get('api_key')
+
+    if api_key is None:
+        return json.dumps(['Access denied.']), 403
+    elif api_key != os.getenv('API_KEY'):
+        return json.dumps(['Access denied.']), 403
+
+    results = qa_lib.rebuild_hash_index()
+
+    return json.dumps(results), 200
+
+
+@api.route(prefix + version + endpoint + 'reset_permissions', methods=['GET'])
 def reset_permissions():
     """
     Resets collection folder permissions
-    :return: boolean
+    :return: Json
     """
 
     api_key = request.args.get('api_key')
@@ -498,7 +954,96 @@ def reset_permissions():
     return json.dumps(is_reset), 200
 
 
-@app.route(prefix + version + endpoint + 'cleanup_sftp', methods=['GET'])
+@api.route(prefix + version + endpoint + 'enqueue-tasks', methods=['GET'])
+def enqueue_tasks():
+    """
+    Queues per-package tasks (check_file_names, hash_package, transfer_package) for qa workers
+    @param: api_key
+    @param: folder
+    @param: task
+    @param: uuid
+    @returns: Json
+    """
+
+    api_key = request.args.get('api_key')
+    folder = request.args.get('folder')
+    task = request.args.get('task')
+    uuid = request.args.get('uuid')
+    errors = []
+
+    if api_key is None:
+        errors.append('Access denied.')
+    elif api_key != os.getenv('API_KEY'):
+        errors.append('Access denied.')
+
+    if len(errors) > 0:
+        return json.dumps(errors), 403
+
+    if folder is None:
+        return json.dumps(['Bad Request: Missing folder param']), 400
+
+    if task is None:
+        return json.dumps(['Bad Request: Missing task param']), 400
+
+    if task == 'transfer_package' and uuid is None:
+        return json.dumps(['Bad Request: Missing uuid param.']), 400
+
+    results = qa_lib.enqueue_package_tasks(folder, task, uuid)
+
+    return json.dumps(results), 200
+
+
+@api.route(prefix + version + endpoint + 'task-status', methods=['GET'])
+def get_task_status():
+    """
+    Gets state and result of a queued task
+    @param: api_key
+    @param: job
+    @returns: Json
+    """
+
+    api_key = request.args.get('api_key')
+    job = request.args.get('job')
+    errors = []
+
+    if api_key is None:
+        errors.append('Access denied.')
+    elif api_key != os.getenv('API_KEY'):
+        errors.append('Access denied.')
+
+    if len(errors) > 0:
+        return json.dumps(errors), 403
+
+    if job is None:
+        return json.dumps(['Bad Request: Missing job param']), 400
+
+    results = qa_lib.get_task_status(job)
+
+    if results['result'] is None:
+        return json.dumps(results['errors']), 404
+
+    return json.dumps(results), 200
+
+
+@api.route(prefix + version + endpoint + 'io-status', methods=['GET'])
+def get_io_status():
+    """
+    Gets adaptive concurrency limit and latency of shared storage operations
+    @param: api_key
+    @returns: Json
+    """
+
+    api_key = request.args.get('api_key')
+
+    if api_key is None:
+        return json.dumps(['Access denied.']), 403
+    elif api_key != os.getenv('API_KEY'):
+        return json.dumps(['Access denied.']), 403
+
+    return json.dumps(qa_lib.get_io_status()), 200
+
+
+@api.route(prefix + version + endpoint + 'cleanup_sftp', methods=['GET'])
 def clean_up_sftp():
     """
     Removes collection folder from Archivematica SFTP server
@@ -517,5 +1062,7 @@ def clean_up_sftp():
     return json.dumps('collection folder removed'), 200
 
 
-app.debug = True
-serve(app, host='0.0.0.0', port=os.getenv('APP_PORT'))
+if __name__ == '__main__':
+    from waitress import serve
+
+    serve(create_app(), host='0.0.0.0', port=os.getenv('APP_PORT'), threads=app_threads)
@@ -1,9 +1,21 @@
+import concurrent.futures
+import cProfile
+import fcntl
+import functools
+import hashlib
+import inspect
+import itertools
+import json
 import os
+import queue
+import re
 import shutil
+import subprocess
 import threading
+import time
+from contextlib import contextmanager
 from os.path import join, dirname
 
-import pysftp
 from dotenv import load_dotenv
 
 dotenv_path = join(dirname(__file__), '.env')
@@ -22,6 +34,387 @@ wasabi_profile = os.getenv('WASABI_PROFILE')
 uid = os.getenv('UID')
 gid = os.getenv('GID')
 errors_file = os.getenv('ERRORS_FILE')
+io_threads = int(os.getenv('IO_THREADS', '8'))
+aws_cli = '/usr/local/bin/aws'
+transfer_chunk_size = 1024 * 1024
+transfer_buffer_chunks = 8
+hash_index_file = os.getenv('HASH_INDEX_FILE', 'hash_index.json')
+hash_index_lock = threading.Lock()
+ready_hash_file = os.getenv('READY_HASH_FILE', 'ready_hashes.json')
+ready_hash_lock = threading.Lock()
+progress = {}
+progress_condition = threading.Condition()
+progress_interval = 0.5
+progress_idle_limit = int(os.getenv('PROGRESS_IDLE_LIMIT', '4'))
+sftp_status = {}
+sftp_status_lock = threading.Lock()
+sftp_status_ttl = float(os.getenv('UPLOAD_STATUS_TTL', '5'))
+queue_path = os.getenv('QUEUE_PATH')
+queue_claim_timeout = int(os.getenv('QUEUE_CLAIM_TIMEOUT', '3600'))
+queue_heartbeat_interval = float(os.getenv('QUEUE_HEARTBEAT_INTERVAL', '60'))
+queue_states = ('pending', 'claimed', 'done', 'failed')
+batch_watch_interval = 2.0
+list_batch_size = 512  # directory entries read per io slot when listing
+io_latency_target = float(os.getenv('IO_LATENCY_TARGET_MS', '50')) / 1000
+io_adjust_interval = 1.0
+io_state = dict(limit=io_threads, active=0, latency={}, slow={}, adjusted=0.0, decreased=0.0)
+io_condition = threading.Condition()
+trace_file = os.getenv('TRACE_FILE', 'traces.json')
+trace_lock = threading.Lock()
+trace_context = threading.local()
+profile_context = threading.local()
+format_header_size = 4096
+file_formats = {
+    'tif': ('tiff',), 'tiff': ('tiff',),
+    'jpg': ('jpeg',), 'jpeg': ('jpeg',),
+    'jp2': ('jp2',), 'j2k': ('jp2',), 'jpf': ('jp2',), 'jpx': ('jp2',),
+    'pdf': ('pdf',),
+    'wav': ('wav',),
+    'mp4': ('mp4',), 'm4a': ('mp4',), 'm4v': ('mp4',), 'mov': ('mp4', 'mov'),
+    'xml': ('xml',),
+    'txt': ('txt', 'xml')
+}
+uri_cache = {}
+uri_cache_lock = threading.Lock()
+uri_pattern = re.compile(r'^/repositories/\d+/(resources|archival_objects|digital_objects|accessions)/\d+$')
+batch_state_file = os.getenv('BATCH_STATE_FILE', 'batches.json')
+batch_state_lock = threading.Lock()
+throughput_file = os.getenv('THROUGHPUT_FILE', 'throughput.json')
+throughput_lock = threading.Lock()
+space_margin = float(os.getenv('SPACE_MARGIN', '0.1'))
+manifest_path = os.getenv('MANIFEST_PATH', 'manifests')
+s3_multipart_threshold = int(os.getenv('S3_MULTIPART_THRESHOLD', str(8 * 1024 * 1024)))
+s3_multipart_chunksize = int(os.getenv('S3_MULTIPART_CHUNKSIZE', str(8 * 1024 * 1024)))
+s3_stream_threshold = int(os.getenv('S3_STREAM_THRESHOLD', str(64 * 1024 * 1024)))
+s3_upload_processes = int(os.getenv('S3_UPLOAD_PROCESSES', '2'))
+ingested_index_file = os.getenv('INGESTED_INDEX_FILE', 'ingested_index.json')
+ingested_index_lock = threading.Lock()
+ingested_index = dict(mtime=None, index=None)
+final_stages = ('packages_moved_to_ingested_folder', 'packages_not_moved_to_ingested_folder', 'error')
+
+
+class ThreadPoolExecutor(concurrent.futures.ThreadPoolExecutor):
+    """
+    Thread pool whose tasks are profiled with the request that submits them (see get_profiled)
+    """
+
+    def submit(self, fn, /, *args, **kwargs):
+        return super().submit(get_profiled(fn), *args, **kwargs)
+
+
+def start_thread_profiling():
+    """
+    Profiles functions that the current thread runs in other threads (pool tasks, writer threads)
+    until stop_thread_profiling is called. There is one profiler per thread, they are added to the returned list
+    @returns: List
+    """
+
+    profile_context.profiles = []
+
+    return profile_context.profiles
+
+
+def stop_thread_profiling():
+    """
+    Stops profiling functions that the current thread runs in other threads
+    @returns: void
+    """
+
+    profile_context.profiles = None
+
+
+def get_profiled(function):
+    """
+    Wraps a function that will run in another thread so that it is profiled when the calling thread is
+    (see start_thread_profiling), functions are returned unchanged otherwise
+    @param: function
+    @returns: function
+    """
+
+    profiles = getattr(profile_context, 'profiles', None)
+
+    if profiles is None:
+        return function
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+
+        profilers = getattr(profile_context, 'profilers', None)
+
+        if profilers is None:
+            profilers = profile_context.profilers = {}
+
+        profiler = profilers.get(id(profiles))
+
+        if profiler is None:
+            profiler = profilers[id(profiles)] = cProfile.Profile()
+            profiles.append(profiler)
+
+        # threads started by this function are profiled too
+        previous = getattr(profile_context, 'profiles', None)
+        profile_context.profiles = profiles
+
+        try:
+            try:
+                profiler.enable()
+            except ValueError as e:  # another profiler is already active in this thread
+                print(e)
+                return function(*args, **kwargs)
+
+            try:
+                return function(*args, **kwargs)
+            finally:
+                profiler.disable()
+        finally:
+            profile_context.profiles = previous
+
+    return wrapper
+
+
+@contextmanager
+def io_slot(operation):
+    """
+    Runs a shared storage operation (stat, read, rename...) once the adaptive concurrency limit allows it
+    and records its latency
+    @param: operation
+    @returns: Context manager
+    """
+
+    with io_condition:
+        io_condition.wait_for(lambda: io_state['active'] < io_state['limit'])
+        io_state['active'] += 1
+
+    start = time.monotonic()
+
+    try:
+        yield
+    finally:
+        latency = time.monotonic() - start
+
+        with io_condition:
+            io_state['active'] -= 1
+            adjust_io_limit(operation, latency)
+            io_condition.notify_all()
+
+
+def adjust_io_limit(operation, latency):
+    """
+    Adjusts the number of concurrent shared storage operations (AIMD)
+    The limit is halved once per congestion event: when an operation whose average latency is above
+    IO_LATENCY_TARGET_MS had a sample above the target since the last decrease. It is raised by one
+    (up to IO_THREADS) when no operation sampled in the last interval is above the target, so the
+    average of an operation that stopped running does not hold the limit down. Called with io_condition held
+    @param: operation
+    @param: latency
+    @returns: void
+    """
+
+    now = time.monotonic()
+    average = io_state['latency'].get(operation, (latency, now))[0]
+    io_state['latency'][operation] = (0.8 * average + 0.2 * latency, now)
+
+    if latency > io_latency_target:
+        io_state['slow'][operation] = now
+
+    if now - io_state['adjusted'] < io_adjust_interval:
+        return
+
+    io_state['adjusted'] = now
+    congested = [op for op, (average, sampled) in io_state['latency'].items()
+                 if average > io_latency_target and io_state['slow'].get(op, 0.0) > io_state['decreased']]
+    current = [average for average, sampled in io_state['latency'].values() if now - sampled < io_adjust_interval]
+
+    if len(congested) > 0:
+        io_state['limit'] = max(1, io_state['limit'] // 2)
+        io_state['decreased'] = now
+    elif all(average <= io_latency_target for average in current) and io_state['limit'] < io_threads:
+        io_state['limit'] += 1
+
+
+def get_io_status():
+    """
+    Gets current concurrency limit and average latency (seconds) of shared storage operations
+    @returns: Dictionary
+    """
+
+    with io_condition:
+        latency = dict((operation, average) for operation, (average, sampled) in io_state['latency'].items())
+        return dict(limit=io_state['limit'], active=io_state['active'], latency=latency)
+
+
+def traced(stage):
+    """
+    Records a call as a trace span of its batch (see trace_span). The batch is taken from the
+    uuid/pid argument, or from the uuid of the current request (set_trace_batch)
+    @param: stage
+    @returns: Decorator
+    """
+
+    def decorator(function):
+
+        signature = inspect.signature(function)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+
+            arguments = signature.bind_partial(*args, **kwargs).arguments
+            uuid = arguments.get('uuid', arguments.get('pid', getattr(trace_context, 'batch', None)))
+            folder = arguments.get('folder')
+
+            with trace_span(stage, uuid, folder) as attributes:
+                result = function(*args, **kwargs)
+
+                if isinstance(result, dict):
+                    for key, value in result.items():
+                        if key == 'errors':
+                            attributes['qa.error_count'] = len(value)
+                            attributes['qa.errors'] = [str(error) for error in value[:10]]
+                        elif isinstance(value, (str, int, float)):
+                            attributes['qa.' + key] = value
+                        elif isinstance(value, dict):
+                            attributes.update(('qa.' + k, v) for k, v in value.items() if isinstance(v, (str, int, float)))
+
+                return result
+
+        return wrapper
+
+    return decorator
+
+
+@contextmanager
+def trace_span(stage, uuid=None, folder=None):
+    """
+    Records a pipeline stage of a batch as an OpenTelemetry span (exported to TRACE_FILE)
+    The trace id is the batch uuid, so every stage of a batch ends up in the same trace
+    @param: stage
+    @param: uuid
+    @param: folder
+    @returns: Context manager (yields the span attributes)
+    """
+
+    batch = uuid.split('/')[0] if uuid else folder
+    parent = getattr(trace_context, 'span', None)
+    span = dict(traceId=get_trace_id(batch), spanId=os.urandom(8).hex(), name=stage,
+                start=time.time_ns(), attributes={'qa.stage': stage}, error=None)
+
+    if uuid:
+        span['attributes']['qa.uuid'] = uuid
+
+    if folder:
+        span['attributes']['qa.folder'] = folder
+
+    if parent is not None and parent['traceId'] == span['traceId']:
+        span['parentSpanId'] = parent['spanId']
+
+    trace_context.span = span
+
+    try:
+        yield span['attributes']
+    except Exception as e:
+        span['error'] = str(e)
+        raise
+    finally:
+        trace_context.span = parent
+        span['end'] = time.time_ns()
+        export_span(span)
+
+
+def set_trace_batch(uuid):
+    """
+    Sets batch uuid of the current request for spans of stages that only get a folder (check-*)
+    @param: uuid
+    @returns: void
+    """
+
+    trace_context.batch = uuid
+
+
+def set_span_attributes(**attributes):
+    """
+    Adds attributes (bytes, file counts...) to the current span
+    @param: attributes
+    @returns: void
+    """
+
+    span = getattr(trace_context, 'span', None)
+
+    if span is not None:
+        span['attributes'].update(('qa.' + key, value) for key, value in attributes.items())
+
+
+def get_trace_id(batch):
+    """
+    Gets trace id (32 hex characters) of a batch
+    @param: batch
+    @returns: string
+    """
+
+    trace_id = str(batch).replace('-', '').lower()
+
+    if len(trace_id) == 32 and all(c in '0123456789abcdef' for c in trace_id):
+        return trace_id
+
+    return hashlib.sha256(str(batch).encode()).hexdigest()[:32]
+
+
+def export_span(span):
+    """
+    Appends a span to TRACE_FILE in OTLP JSON format (one resourceSpans document per line)
+    @param: span
+    @returns: void
+    """
+
+    attributes = []
+
+    for key, value in span['attributes'].items():
+        attributes.append(dict(key=key, value=get_span_value(value)))
+
+    error_count = span['attributes'].get('qa.error_count', 0)
+
+    if span['error'] is not None:
+        status = dict(code=2, message=span['error'])
+    elif error_count > 0:
+        status = dict(code=2, message=str(error_count) + ' errors')
+    else:
+        status = dict(code=1)
+
+    otel_span = dict(traceId=span['traceId'], spanId=span['spanId'], name=span['name'], kind=1,
+                     startTimeUnixNano=str(span['start']), endTimeUnixNano=str(span['end']),
+                     attributes=attributes, status=status)
+
+    if 'parentSpanId' in span:
+        otel_span['parentSpanId'] = span['parentSpanId']
+
+    resource = dict(attributes=[dict(key='service.name', value=dict(stringValue='digitaldu-qa'))])
+    document = dict(resourceSpans=[dict(resource=resource, scopeSpans=[dict(scope=dict(name='qa_lib'),
+                                                                            spans=[otel_span])])])
+
+    try:
+        with trace_lock:
+            with open(trace_file, 'a') as traces:
+                traces.write(json.dumps(document) + '\n')
+    except Exception as e:
+        print(e)
+        print('ERROR: Unable to write trace file - ' + trace_file)
+
+
+def get_span_value(value):
+    """
+    Converts an attribute value to an OTLP JSON AnyValue
+    @param: value
+    @returns: Dictionary
+    """
+
+    if isinstance(value, bool):
+        return dict(boolValue=value)
+    elif isinstance(value, int):
+        return dict(intValue=str(value))
+    elif isinstance(value, float):
+        return dict(doubleValue=value)
+    elif isinstance(value, (list, tuple)):
+        return dict(arrayValue=dict(values=[get_span_value(v) for v in value]))
+
+    return dict(stringValue=str(value))
 
 
 def get_ready_folders():
@@ -78,6 +471,7 @@ def get_collection_folder_name():
     return folder
 
 
+@traced('check_folder_name')
 def check_folder_name(folder):
     """
     Checks if folder name conforms to naming standard
@@ -107,70 +501,146 @@ def check_folder_name(folder):
 
 def get_package_names(folder):
     """
-    Gets package names
+    Gets package names (generator, hidden files are removed while the collection folder is scanned)
     :param folder:
     :return: packages
     """
 
-    [os.remove(ready_path + folder + '/' + f) for f in os.listdir(ready_path + folder) if f.startswith('.')]
-    packages = [f for f in os.listdir(ready_path + folder) if not f.startswith('.')]
-    return packages
+    with os.scandir(ready_path + folder) as entries:
+        for entry in entries:
+            if entry.name.startswith('.'):
+                os.remove(entry.path)
+            else:
+                yield entry.name
 
 
-def check_package_names(folder):
+@traced('check_package_names')
+def check_package_names(folder, dry_run=False):
     """
     Checks package names and fixes case issues and removes spaces
+    Renames are planned up front so that names that would collide are reported and left unchanged
     @param: folder
+    @param: dry_run
     @returns: Dictionary
     """
 
-    threads = []
-    packages = [f for f in os.listdir(ready_path + folder) if not f.startswith('.')]
-    [os.remove(ready_path + folder + '/' + f) for f in os.listdir(ready_path + folder) if f.startswith('.')]
     errors = []
+    collection = ready_path + folder
+    fd = os.open(collection, os.O_RDONLY | os.O_DIRECTORY)
 
-    if len(packages) == 0:
-        errors.append(['No packages found'])
+    try:
+        names = os.listdir(fd)
 
-    for i in packages:
+        if not dry_run:
+            [os.remove(f, dir_fd=fd) for f in names if f.startswith('.')]
 
-        thread = threading.Thread(target=check_package_names_threads, args=(folder, i))
-        threads.append(thread)
-        thread.start()
+        packages = [f for f in names if not f.startswith('.')]
 
-        for thread in threads:
-            thread.join()
+        if len(packages) == 0:
+            errors.append(['No packages found'])
+
+        renames, rename_errors = plan_renames(packages, True)
+        errors += rename_errors
+
+        if not dry_run:
+            errors += apply_renames(fd, renames)
+    finally:
+        os.close(fd)
 
-    return dict(result='package_names_checked.', errors=errors)
+    return dict(result='package_names_checked.', errors=errors, renames=renames)
 
 
-def check_package_names_threads(folder, i):
+def get_normalized_name(name, is_package):
     """
-    Processes packages (thread function for check_package_names)
-    @param: folder
-    @param: i
-    @returns: Dictionary
+    Gets name without spaces (names without an extension are also lower cased)
+    Package names with a call number (.) are not changed
+    @param: name
+    @param: is_package
+    @returns: string
+    """
+
+    call_number = name.find('.')
+
+    if call_number == -1:
+        return name.lower().replace(' ', '')
+    elif is_package:
+        return name
+
+    return name.replace(' ', '')
+
+
+def plan_renames(names, is_package, exists=None):
+    """
+    Plans renames for names in a folder and detects collisions
+    Names that would collide with each other or with an existing name are not renamed
+    @param: names
+    @param: is_package
+    @param: exists (checks whether a name exists in the folder, defaults to membership in names)
+    @returns: Tuple
+    """
+
+    errors = []
+    targets = {}
+    collisions = set()
+
+    if exists is None:
+        names = list(names)
+        exists = set(names).__contains__
+
+    for name in names:
+
+        new_name = get_normalized_name(name, is_package)
+
+        if new_name == name:
+            continue
+
+        if exists(new_name):
+            errors.append(name + ' can not be renamed to ' + new_name + ' because it already exists')
+        elif new_name in targets:
+            errors.append(name + ' and ' + targets[new_name] + ' would both be renamed to ' + new_name)
+            collisions.add(new_name)
+        else:
+            targets[new_name] = name
+
+    renames = [[name, new_name] for new_name, name in targets.items() if new_name not in collisions]
+
+    return renames, errors
+
+
+def apply_renames(fd, renames):
+    """
+    Applies planned renames relative to an open folder
+    @param: fd
+    @param: renames
+    @returns: List
     """
 
-    package = ready_path + folder + '/'
+    errors = []
 
-    if i.upper():
-        call_number = i.find('.')
+    for name, new_name in renames:
+        try:
+            with io_slot('rename'):
+                os.rename(name, new_name, src_dir_fd=fd, dst_dir_fd=fd)
+        except Exception as e:
+            print(e)
+            errors.append('Unable to rename ' + name + ' to ' + new_name)
 
-        if call_number == -1:
-            os.rename(package + i, package + i.lower().replace(' ', ''))
+    return errors
 
 
-def check_file_names(folder):
+@traced('check_file_names')
+def check_file_names(folder, dry_run=False):
     """
     Checks file names and fixes case issues and removes spaces
     @param: folder
+    @param: dry_run
     @returns: Dictionary
     """
 
     packages = [f for f in os.listdir(ready_path + folder) if not f.startswith('.')]
-    threads = []
-    files_arr = []
+    local_file_count = 0
+    renames = []
+    rename_errors = []
     errors = []
 
     try:
@@ -180,27 +650,18 @@ def check_file_names(folder):
         print(e)
         print('Unable to delete errors_file')
 
-    for i in packages:
-
-        thread = threading.Thread(target=check_file_names_threads, args=(folder, i))
-        threads.append(thread)
-        thread.start()
-
-        # Get total file count from packages
-        package = ready_path + folder + '/' + i + '/'
-        files = [f for f in os.listdir(package) if not f.startswith('.')]
-        [os.remove(package + f) for f in os.listdir(package) if f.startswith('.')]
-
-        if len(files) < 2:
-            errors.append(i + '  is missing files.')
+    with ThreadPoolExecutor(max_workers=io_threads) as executor:
+        results = executor.map(lambda i: check_file_names_threads(folder, i, dry_run), packages)
 
-        for j in files:
-            files_arr.append(j)
+        for i, (file_count, package_renames, package_errors) in zip(packages, results):
 
-        local_file_count = len(files_arr)
+            # Get total file count from packages
+            if file_count < 2:
+                errors.append(i + '  is missing files.')
 
-    for thread in threads:
-        thread.join()
+            local_file_count += file_count
+            renames += [[i + '/' + name, i + '/' + new_name] for name, new_name in package_renames]
+            rename_errors += [i + '/' + error for error in package_errors]
 
     try:
         with open(errors_file) as file_errors:
@@ -209,33 +670,69 @@ def check_file_names(folder):
         print(e)
         print('ERROR: Unable to open error file - ' + errors_file)
 
-    return dict(result=local_file_count, errors=errors)
+    return dict(result=local_file_count, errors=errors + rename_errors, renames=renames)
 
 
-def check_file_names_threads(folder, i):
+def check_file_names_threads(folder, i, dry_run):
     """
     Processes packages (thread function for check_file_names)
     @param: folder
     @param: i
-    @returns: void
+    @param: dry_run
+    @returns: Tuple
     """
 
-    package = ready_path + folder + '/' + i + '/'
-    files = [f for f in os.listdir(package) if not f.startswith('.')]
-    [os.remove(package + f) for f in os.listdir(package) if f.startswith('.')]
+    errors = []
+
+    try:
+        fd = os.open(ready_path + folder + '/' + i, os.O_RDONLY | os.O_DIRECTORY)
+    except Exception as e:
+        print(e)
+        return 0, [], ['Unable to open package']
+
+    try:
+        file_count = 0
+        candidates = []
+
+        # Only names that need a rename are kept, existing names are checked against the folder
+        with os.scandir(fd) as entries:
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    if not dry_run:
+                        os.remove(entry.name, dir_fd=fd)
+                    continue
+
+                file_count += 1
 
-    for j in files:
+                if get_normalized_name(entry.name, False) != entry.name:
+                    candidates.append(entry.name)
 
-        if j.upper():
+        renames, errors = plan_renames(candidates, False, lambda name: name_exists(fd, name))
 
-            call_number = j.find('.')
+        if not dry_run:
+            errors += apply_renames(fd, renames)
+    finally:
+        os.close(fd)
+
+    return file_count, renames, errors
+
+
+def name_exists(fd, name):
+    """
+    Checks whether a name exists in an open folder
+    @param: fd
+    @param: name
+    @returns: Boolean
+    """
 
-            if call_number == -1:
-                os.rename(package + j, package + j.lower().replace(' ', ''))
-            elif call_number != -1:
-                os.rename(package + j, package + j.replace(' ', ''))
+    try:
+        os.stat(name, dir_fd=fd, follow_symlinks=False)
+        return True
+    except FileNotFoundError:
+        return False
 
 
+@traced('check_uri_txt')
 def check_uri_txt(folder):
     """
     Checks for missing uri.txt files
@@ -253,9 +750,8 @@ def check_uri_txt(folder):
     for i in packages:
 
         package = ready_path + folder + '/' + i + '/'
-        files = [f for f in os.listdir(package) if not f.startswith('.')]
 
-        if 'uri.txt' not in files:
+        if not os.path.isfile(package + 'uri.txt'):
             errors.append(i + ' is missing a uri.txt file')
 
     return dict(result='URI txt files checked', errors=errors)
@@ -283,6 +779,81 @@ def get_uri_txt(folder, package):
     return dict(result=uris, errors=errors)
 
 
+def get_uri_txts(folder):
+    """
+    Gets ArchivesSpace URIs of all packages in a collection, checks their format and
+    flags URIs used by more than one package
+    @param: folder
+    @returns: Dictionary
+    """
+
+    errors = []
+    uris = {}
+    packages_by_uri = {}
+    collection = ready_path + folder
+
+    with os.scandir(collection) as entries:
+        packages = sorted(entry.name for entry in entries
+                          if not entry.name.startswith('.') and entry.is_dir(follow_symlinks=False))
+
+    with ThreadPoolExecutor(max_workers=io_threads) as executor:
+        results = executor.map(read_uri_txt, [collection + '/' + package + '/uri.txt' for package in packages])
+
+        for package, uri in zip(packages, results):
+
+            uris[package] = uri
+
+            if uri is None:
+                errors.append(package + ' is missing a uri.txt file')
+                continue
+
+            if uri_pattern.match(uri.strip()) is None:
+                errors.append(package + ' has an invalid uri - ' + uri.strip())
+
+            packages_by_uri.setdefault(uri.strip(), []).append(package)
+
+    for uri, uri_packages in packages_by_uri.items():
+        if len(uri_packages) > 1:
+            errors.append(uri + ' is used by more than one package - ' + ', '.join(uri_packages))
+
+    return dict(result=uris, errors=errors)
+
+
+def read_uri_txt(path):
+    """
+    Reads a uri.txt file (contents are cached until the file's mtime or size changes)
+    @param: path
+    @returns: string
+    """
+
+    try:
+        with io_slot('stat'):
+            stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+
+    key = (stat.st_mtime_ns, stat.st_size)
+
+    with uri_cache_lock:
+        cached = uri_cache.get(path)
+
+    if cached is not None and cached[0] == key:
+        return cached[1]
+
+    try:
+        with io_slot('read'):
+            with open(path, 'r') as uri:
+                uri_text = uri.read()
+    except Exception as e:
+        print(e)
+        return None
+
+    with uri_cache_lock:
+        uri_cache[path] = (key, uri_text)
+
+    return uri_text
+
+
 def get_total_batch_size(folder):
     """
     Checks package file size (bytes)
@@ -317,250 +888,2238 @@ def get_package_file_count(collection_folder, package):
     @returns: count
     """
 
-    try:
-        dir_path = ready_path + collection_folder + '/' + package
-        count = 0
-        # Iterate directory
-        for path in os.listdir(dir_path):
-            # check if current path is a file
-            if os.path.isfile(os.path.join(dir_path, path)):
-                count += 1
+    count = count_package_files(ready_path + collection_folder + '/' + package)
+
+    if count is not None:
         print('File count:', count)
 
-        return count
-    except Exception as e:
-        print(e)
+    return count
 
 
-def move_to_ingest(uuid, folder, package):
-    '''
-    Moves folder from ready to ingest folder and renames it using pid
-    @param: pid
+def get_collection_file_counts(folder):
+    """
+    Gets file count of every package in a collection and the batch total
+    Each package folder is scanned once and only file entries are counted
     @param: folder
-    @param: package
     @returns: Dictionary
-    '''
+    """
 
     errors = []
-    mode = 0o777
+    file_counts = {}
+    collection = ready_path + folder
 
-    # create collection uuid folder in 002-ingest folder
-    try:
-        os.mkdir(ingest_path + uuid, mode)
-    except Exception as e:
-        print(e)
-        errors.append('ERROR: Unable to create folder (move_to_ingest)')
+    with os.scandir(collection) as entries:
+        packages = sorted(entry.name for entry in entries
+                          if not entry.name.startswith('.') and entry.is_dir(follow_symlinks=False))
 
-    # move package to new uuid folder in 002-ingest
-    try:
-        shutil.move(ready_path + folder + '/' + package, ingest_path + uuid)
-    except Exception as e:
-        print(e)
+    with ThreadPoolExecutor(max_workers=io_threads) as executor:
+        for package, count in zip(packages, executor.map(count_package_files, [collection + '/' + p for p in packages])):
+            if count is None:
+                errors.append('Unable to count files in ' + package)
+            else:
+                file_counts[package] = count
+
+    return dict(result=dict(packages=file_counts, total_batch_file_count=sum(file_counts.values())), errors=errors)
+
+
+def count_package_files(path):
+    """
+    Counts files in a package folder (single scandir pass)
+    The directory is read in batches of list_batch_size entries, each batch in its own concurrency slot
+    recorded as 'list' so that a large listing is neither held as one slot nor averaged with stats
+    (is_file uses the file type returned with the listing)
+    @param: path
+    @returns: int
+    """
+
+    count = 0
+
+    try:
+        with os.scandir(path) as entries:
+            while True:
+
+                with io_slot('list'):
+                    batch = list(itertools.islice(entries, list_batch_size))
+
+                count += sum(1 for entry in batch if entry.is_file())
+
+                if len(batch) < list_batch_size:
+                    return count
+    except Exception as e:
+        print(e)
+        return None
+
+
+def add_batch_package(uuid, folder, package, file_count):
+    """
+    Records a package moved into a batch so that the expected batch file count is known server side
+    @param: uuid
+    @param: folder
+    @param: package
+    @param: file_count
+    @returns: void
+    """
+
+    with batch_state_lock:
+        batches = load_json_file(batch_state_file)
+        batch = batches.setdefault(uuid, dict(folder=folder, packages={}, created=time.time()))
+        batch['packages'][package] = file_count
+        batch['total_batch_file_count'] = sum(batch['packages'].values())
+        save_json_file(batch_state_file, batches)
+
+
+def get_batch(uuid):
+    """
+    Gets stored state of a batch (folder, package file counts and total)
+    @param: uuid
+    @returns: Dictionary
+    """
+
+    with batch_state_lock:
+        return load_json_file(batch_state_file).get(uuid)
+
+
+@traced('check_ingested')
+def check_ingested(folder):
+    """
+    Checks which packages of a collection were already ingested (ingested index lookup per package)
+    @param: folder
+    @returns: Dictionary
+    """
+
+    errors = []
+    new_packages = []
+    ingested_packages = []
+    index = load_ingested_index()
+
+    for package in sorted(f for f in os.listdir(ready_path + folder) if not f.startswith('.')):
+
+        entry = index['packages'].get(package)
+
+        if entry is None:
+            new_packages.append(package)
+        else:
+            ingested_packages.append(package)
+            errors.append(package + ' was already ingested in ' + entry['collection'] +
+                          (' (' + entry['uuid'] + ')' if entry.get('uuid') else ''))
+
+    return dict(result=dict(new_packages=new_packages, ingested_packages=ingested_packages), errors=errors)
+
+
+def load_ingested_index():
+    """
+    Loads the index of ingested collections and packages (kept in memory until the file changes)
+    @returns: Dictionary
+    """
+
+    with ingested_index_lock:
+
+        try:
+            mtime = os.stat(ingested_index_file).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+
+        if ingested_index['index'] is None or ingested_index['mtime'] != mtime:
+            ingested_index.update(mtime=mtime, index=read_ingested_index())
+
+        return ingested_index['index']
+
+
+def read_ingested_index():
+    """
+    Reads the ingested index file
+    @returns: Dictionary
+    """
+
+    index = load_json_file(ingested_index_file)
+    index.setdefault('collections', {})
+    index.setdefault('packages', {})
+
+    return index
+
+
+def update_ingested_index(uuid, manifest):
+    """
+    Adds packages of a transferred batch to the ingested index (called by the move stage)
+    @param: uuid
+    @param: manifest
+    @returns: void
+    """
+
+    packages = {}
+
+    for key, entry in manifest.items():
+        parts = key.split('/')
+
+        if len(parts) > 2:
+            packages.setdefault((parts[0], parts[1]), {})[key] = entry
+
+    # workers on other hosts update the same file, it is read again while it is locked
+    with ingested_index_lock, lock_file(ingested_index_file):
+
+        index = read_ingested_index()
+
+        for (collection, package), entries in packages.items():
+
+            manifest_hash = hashlib.sha256(json.dumps(entries, sort_keys=True).encode()).hexdigest()
+            index['packages'][package] = dict(collection=collection, uuid=uuid.split('/')[0],
+                                              file_count=len(entries),
+                                              bytes=sum(entry['size'] for entry in entries.values()),
+                                              manifest_hash=manifest_hash, ingested=time.time())
+            collection_packages = index['collections'].setdefault(collection, dict(packages=[]))['packages']
+
+            if package not in collection_packages:
+                collection_packages.append(package)
+
+        save_json_file(ingested_index_file, index)
+
+
+def rebuild_ingested_index():
+    """
+    Adds collections and packages found in the ingested folder that are not in the ingested index yet
+    (uuid and manifest hash are unknown for those)
+    @returns: Dictionary
+    """
+
+    known = load_ingested_index()['packages']
+    found = {}
+    added = 0
+
+    # the ingested folder is walked without holding the index lock
+    for collection in sorted(f for f in os.listdir(ingested_path) if not f.startswith('.')):
+
+        if not os.path.isdir(ingested_path + collection):
+            continue
+
+        found[collection] = {}
+
+        with os.scandir(ingested_path + collection) as entries:
+            packages = [entry for entry in entries
+                        if not entry.name.startswith('.') and entry.is_dir(follow_symlinks=False)]
+
+        for package in packages:
+
+            if package.name in known:
+                continue
+
+            file_count = 0
+            size = 0
+
+            for f in iter_files(package.path):
+                file_count += 1
+                size += f.stat().st_size
+
+            found[collection][package.name] = dict(collection=collection, uuid=None, file_count=file_count,
+                                                   bytes=size, manifest_hash=None, ingested=package.stat().st_mtime)
+
+    with ingested_index_lock, lock_file(ingested_index_file):
+
+        index = read_ingested_index()
+
+        for collection, packages in found.items():
+
+            collection_packages = index['collections'].setdefault(collection, dict(packages=[]))['packages']
+
+            for package, entry in packages.items():
+
+                if package in index['packages']:
+                    continue
+
+                index['packages'][package] = entry
+
+                if package not in collection_packages:
+                    collection_packages.append(package)
+
+                added += 1
+
+        save_json_file(ingested_index_file, index)
+
+    return dict(result=dict(collections=len(index['collections']), packages=len(index['packages']), added=added),
+                errors=[])
+
+
+@traced('check_file_formats')
+def check_file_formats(folder):
+    """
+    Checks that file contents match their extensions (magic bytes) and that files are not empty
+    Only the first format_header_size bytes of each file are read
+    @param: folder
+    @returns: Dictionary
+    """
+
+    errors = []
+    collection = ready_path + folder
+    files = [entry.path for entry in iter_files(collection)]
+
+    with ThreadPoolExecutor(max_workers=io_threads) as executor:
+        for path, (size, file_format) in zip(files, executor.map(get_file_format, files)):
+
+            name = os.path.relpath(path, collection)
+            extension = os.path.splitext(path)[1][1:].lower()
+
+            if size is None:
+                errors.append('Unable to read ' + name)
+            elif size == 0:
+                errors.append(name + ' is empty')
+            elif extension in file_formats and file_format not in file_formats[extension]:
+                errors.append(name + ' is not a ' + extension + ' file (' + str(file_format) + ')')
+
+    return dict(result='file_formats_checked', errors=errors)
+
+
+def get_file_format(path):
+    """
+    Identifies file format from its first bytes (single pread)
+    @param: path
+    @returns: Tuple (size, format)
+    """
+
+    try:
+        with io_slot('read'):
+            fd = os.open(path, os.O_RDONLY)
+
+            try:
+                size = os.fstat(fd).st_size
+                header = os.pread(fd, format_header_size, 0)
+            finally:
+                os.close(fd)
+    except Exception as e:
+        print(e)
+        return None, None
+
+    return size, get_format(header)
+
+
+def get_format(header):
+    """
+    Matches magic bytes of formats we ingest
+    @param: header
+    @returns: string
+    """
+
+    # classic TIFF and BigTIFF (large masters)
+    if header[:4] in (b'II*\x00', b'MM\x00*', b'II+\x00', b'MM\x00+'):
+        return 'tiff'
+    elif header.startswith(b'\xff\xd8\xff'):
+        return 'jpeg'
+    elif header.startswith(b'\x00\x00\x00\x0cjP  \r\n\x87\n') or header.startswith(b'\xff\x4f\xff\x51'):
+        return 'jp2'
+    elif header.startswith(b'%PDF-'):
+        return 'pdf'
+    elif header[:4] in (b'RIFF', b'RF64', b'BW64') and header[8:12] == b'WAVE':  # RF64/BW64 are wav over 4 GB
+        return 'wav'
+    elif header[4:8] == b'ftyp':
+        return 'mp4'
+    elif header[4:8] in (b'moov', b'mdat', b'wide', b'free', b'skip', b'pnot'):  # QuickTime files without ftyp
+        return 'mov'
+
+    text = header.lstrip(b'\xef\xbb\xbf').lstrip()
+
+    if text.startswith(b'<'):
+        return 'xml'
+
+    if b'\x00' in header:
+        return None
+
+    try:
+        header.decode('utf-8')
+        return 'txt'
+    except UnicodeDecodeError as e:
+        # the header may end in the middle of a multi-byte character
+        if len(header) == format_header_size and e.start >= len(header) - 3:
+            return 'txt'
+
+    return None
+
+
+@traced('check_duplicates')
+def check_duplicates(folder):
+    """
+    Checks for files and packages that were already ingested or are repeated in the collection
+    Only files whose sizes collide are hashed. Ingested files are looked up in the hash index kept by the move stage,
+    ready files hashed by workers (hash_package tasks) are taken from the ready hash cache
+    @param: folder
+    @returns: Dictionary
+    """
+
+    errors = []
+    collection = ready_path + folder
+    ready_files = []
+    ready_sizes = {}
+
+    for entry in iter_files(collection):
+
+        with io_slot('stat'):
+            stat = entry.stat()
+
+        size = stat.st_size
+
+        if size > 0:
+            ready_files.append((os.path.relpath(entry.path, collection), size, stat.st_mtime_ns))
+            ready_sizes[size] = ready_sizes.get(size, 0) + 1
+
+    index = load_hash_index()
+    ingested_sizes = {}
+
+    for path, (size, mtime, digest) in index.items():
+        ingested_sizes.setdefault(size, []).append(path)
+
+    candidates = [(path, size, mtime) for path, size, mtime in ready_files
+                  if size in ingested_sizes or ready_sizes[size] > 1]
+    sizes = set(size for path, size, mtime in candidates)
+    unhashed = [path for size in sizes for path in ingested_sizes.get(size, []) if index[path][2] is None]
+
+    # files indexed without a hash (bootstrap walk) are hashed outside the lock and only when their size collides
+    if len(unhashed) > 0:
+        with ThreadPoolExecutor(max_workers=io_threads) as executor:
+            hashes = dict(zip(unhashed, executor.map(hash_file, [ingested_path + p for p in unhashed])))
+
+        with hash_index_lock, lock_file(hash_index_file):
+            saved = load_json_file(hash_index_file)
+
+            for path, digest in hashes.items():
+                index[path][2] = digest
+
+                if saved.get(path) is not None and saved[path][:2] == index[path][:2]:
+                    saved[path][2] = digest
+
+            save_json_file(hash_index_file, saved)
+
+    ingested_hashes = {}
+
+    for path, (size, mtime, digest) in index.items():
+        if digest is not None:
+            ingested_hashes.setdefault(digest, path)
+
+    cached = load_json_file(ready_hash_file)
+    ready_hashes = {}
+    uncached = []
+
+    for path, size, mtime in candidates:
+        entry = cached.get(folder + '/' + path)
+
+        if entry is not None and entry[0] == size and entry[1] == mtime:
+            ready_hashes[path] = entry[2]
+        else:
+            uncached.append(path)
+
+    with ThreadPoolExecutor(max_workers=io_threads) as executor:
+        ready_hashes.update(zip(uncached, executor.map(hash_file, [collection + '/' + path for path in uncached])))
+
+    seen = {}
+    package_hashes = {}
+    duplicate_counts = {}
+
+    for path, size, mtime in candidates:
+
+        digest = ready_hashes[path]
+
+        if digest is None:
+            errors.append('Unable to hash ' + path)
+            continue
+
+        package = path.split('/')[0]
+        package_hashes.setdefault(package, set()).add(digest)
+
+        if digest in ingested_hashes:
+            errors.append(path + ' is a duplicate of ingested file ' + ingested_hashes[digest])
+            duplicate_counts[package] = duplicate_counts.get(package, 0) + 1
+        elif digest in seen:
+            errors.append(path + ' is a duplicate of ' + seen[digest])
+        else:
+            seen[digest] = path
+
+    file_counts = {}
+
+    for path, size, mtime in ready_files:
+        package = path.split('/')[0]
+        file_counts[package] = file_counts.get(package, 0) + 1
+
+    for package, count in duplicate_counts.items():
+        if count == file_counts[package]:
+            errors.append(package + ' was already ingested')
+
+    packages = sorted(package for package in package_hashes if len(package_hashes[package]) == file_counts[package])
+
+    for i, package in enumerate(packages):
+        for other in packages[:i]:
+            if package_hashes[package] == package_hashes[other]:
+                errors.append(package + ' is a duplicate of package ' + other)
+
+    return dict(result='duplicates_checked', errors=errors)
+
+
+def iter_files(path):
+    """
+    Walks a folder and yields file entries (hidden files and folders are skipped)
+    @param: path
+    @returns: Generator
+    """
+
+    with os.scandir(path) as entries:
+        for entry in entries:
+
+            if entry.name.startswith('.'):
+                continue
+
+            if entry.is_dir(follow_symlinks=False):
+                yield from iter_files(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                yield entry
+
+
+def hash_file(path):
+    """
+    Gets sha256 hash of a file
+    @param: path
+    @returns: string
+    """
+
+    digest = hashlib.sha256()
+
+    try:
+        with open(path, 'rb') as file:
+            while True:
+
+                with io_slot('read'):
+                    chunk = file.read(transfer_chunk_size)
+
+                if not chunk:
+                    break
+
+                digest.update(chunk)
+    except Exception as e:
+        print(e)
+        return None
+
+    return digest.hexdigest()
+
+
+def load_hash_index():
+    """
+    Loads the content hash index of the ingested folder (the ingested folder is walked when there is no index yet)
+    @returns: Dictionary
+    """
+
+    if os.path.exists(hash_index_file):
+        return load_json_file(hash_index_file)
+
+    with hash_index_lock, lock_file(hash_index_file):
+
+        if os.path.exists(hash_index_file):
+            return load_json_file(hash_index_file)
+
+        index = build_hash_index({})
+        save_json_file(hash_index_file, index)
+
+        return index
+
+
+def update_ready_hashes(folder, package, hashes):
+    """
+    Adds hashes of ready files computed by a worker (hash_package task) to the ready hash cache
+    Entries are only used while size and mtime of the file are unchanged
+    @param: folder
+    @param: package
+    @param: hashes (file path in the package: [size, mtime, hash])
+    @returns: void
+    """
+
+    with ready_hash_lock, lock_file(ready_hash_file):
+
+        cache = load_json_file(ready_hash_file)
+
+        for path, entry in hashes.items():
+            if entry[2] is not None:
+                cache[folder + '/' + package + '/' + path] = entry
+
+        save_json_file(ready_hash_file, cache)
+
+
+def remove_ready_hashes(folder, package):
+    """
+    Removes cached hashes of a package that left the ready folder
+    @param: folder
+    @param: package
+    @returns: void
+    """
+
+    if not os.path.exists(ready_hash_file):
+        return
+
+    prefix = folder + '/' + package + '/'
+
+    with ready_hash_lock, lock_file(ready_hash_file):
+
+        cache = load_json_file(ready_hash_file)
+        remaining = dict((path, entry) for path, entry in cache.items() if not path.startswith(prefix))
+
+        if len(remaining) < len(cache):
+            save_json_file(ready_hash_file, remaining)
+
+
+def update_hash_index(manifest):
+    """
+    Adds the files of a transferred batch to the hash index (called by the move stage)
+    @param: manifest
+    @returns: void
+    """
+
+    with hash_index_lock, lock_file(hash_index_file):
+
+        index = load_json_file(hash_index_file)
+
+        for key, entry in manifest.items():
+            try:
+                stat = os.stat(ingested_path + key)
+            except Exception as e:
+                print(e)
+                continue
+
+            index[key] = [entry['size'], stat.st_mtime_ns, entry.get('sha256')]
+
+        save_json_file(hash_index_file, index)
+
+
+def rebuild_hash_index():
+    """
+    Walks the ingested folder and updates the hash index (for files changed outside of the move stage)
+    @returns: Dictionary
+    """
+
+    with hash_index_lock, lock_file(hash_index_file):
+
+        index = build_hash_index(load_json_file(hash_index_file))
+        save_json_file(hash_index_file, index)
+
+    return dict(result=dict(files=len(index)), errors=[])
+
+
+def build_hash_index(index):
+    """
+    Walks the ingested folder and builds its content hash index
+    Entries keep their hash while size and mtime are unchanged; new entries are hashed on demand
+    @param: index
+    @returns: Dictionary
+    """
+
+    updated = {}
+
+    for entry in iter_files(ingested_path):
+
+        with io_slot('stat'):
+            stat = entry.stat()
+
+        path = os.path.relpath(entry.path, ingested_path)
+        previous = index.get(path)
+
+        if previous is not None and previous[0] == stat.st_size and previous[1] == stat.st_mtime_ns:
+            updated[path] = previous
+        else:
+            updated[path] = [stat.st_size, stat.st_mtime_ns, None]
+
+    return updated
+
+
+@contextmanager
+def lock_file(path):
+    """
+    Holds an exclusive lock on a state file (flock on path.lock) so that read-modify-write updates
+    from other processes and hosts sharing the file are not lost
+    @param: path
+    @returns: Context manager
+    """
+
+    with open(path + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def load_json_file(path):
+    """
+    Loads a json state file (hash index, batch state...)
+    @param: path
+    @returns: Dictionary
+    """
+
+    try:
+        with open(path) as json_file:
+            return json.load(json_file)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        print(e)
+        print('ERROR: Unable to open file - ' + path)
+        return {}
+
+
+def save_json_file(path, data):
+    """
+    Saves a json state file (written to a temporary file first so that readers never see partial files)
+    @param: path
+    @param: data
+    @returns: void
+    """
+
+    try:
+        with open(path + '.tmp', 'w') as json_file:
+            json.dump(data, json_file)
+        os.replace(path + '.tmp', path)
+    except Exception as e:
+        print(e)
+        print('ERROR: Unable to save file - ' + path)
+
+
+@traced('move_to_ingest')
+def move_to_ingest(uuid, folder, package):
+    '''
+    Moves folder from ready to ingest folder and renames it using pid
+    @param: pid
+    @param: folder
+    @param: package
+    @returns: Dictionary
+    '''
+
+    errors = []
+    mode = 0o777
+
+    # create collection uuid folder in 002-ingest folder
+    try:
+        os.mkdir(ingest_path + uuid, mode)
+    except Exception as e:
+        print(e)
+        errors.append('ERROR: Unable to create folder (move_to_ingest)')
+
+    file_count = count_package_files(ready_path + folder + '/' + package)
+
+    # move package to new uuid folder in 002-ingest
+    try:
+        shutil.move(ready_path + folder + '/' + package, ingest_path + uuid)
+
+        # keep the expected batch file count server side (see check_sftp)
+        if file_count is None:
+            errors.append('ERROR: Unable to count package files (move_to_ingest)')
+        else:
+            add_batch_package(uuid, folder, package, file_count)
+
+        remove_ready_hashes(folder, package)
+    except Exception as e:
+        print(e)
         errors.append('ERROR: Unable to move folder (move_to_ingest)')
 
     if len(errors) == 0:
-        result = 'packages_moved_to_ingested_folder.'
+        result = 'packages_moved_to_ingested_folder.'
+    else:
+        result = 'packages_not_moved_to_ingested_folder.'
+
+    return dict(result=result, errors=errors)
+
+
+def get_sftp_connection():
+    """
+    Opens a connection to the Archivematica sftp server
+    pysftp (and paramiko) is imported on first use to keep application startup fast
+    @returns: Connection
+    """
+
+    import pysftp
+
+    cnopts = pysftp.CnOpts()
+    cnopts.hostkeys = None
+
+    return pysftp.Connection(host=sftp_host, username=sftp_username, password=sftp_password, cnopts=cnopts)
+
+
+@traced('move_to_sftp')
+def move_to_sftp(pid):
+    """"
+    Moves folder to Archivematica sftp via ssh
+    The upload is refused when the sftp server does not have enough free space
+    @param: pid
+    @returns: Dictionary
+    """
+
+    errors = []
+    uploads = []
+    total_size = 0
+
+    for dirpath, dirnames, filenames in os.walk(ingest_path):
+        for f in filenames:
+            local_file = os.path.join(dirpath, f)
+            uploads.append(local_file)
+            total_size += os.path.getsize(local_file)
+
+    publish_progress(pid, stage='uploading_to_sftp', total_files=len(uploads), total_bytes=total_size)
+    set_span_attributes(file_count=len(uploads), total_size=total_size)
+
+    start = time.monotonic()
+
+    try:
+        with get_sftp_connection() as sftp:
+
+            free_space = get_remote_free_space(sftp)
+
+            if free_space is not None and free_space < total_size:
+                errors.append('ERROR: Not enough space on Archivematica sftp (' + str(total_size) +
+                              ' bytes needed, ' + str(free_space) + ' bytes free)')
+                publish_progress(pid, stage='error', errors=errors)
+                return dict(result='packages_not_uploaded', errors=errors)
+
+            remote_folders = set()
+            files_done = 0
+            bytes_done = 0
+
+            for local_file in uploads:
+
+                remote_file = sftp_path + '/' + os.path.relpath(local_file, ingest_path)
+                remote_folder = os.path.dirname(remote_file)
+
+                if remote_folder not in remote_folders:
+                    sftp.makedirs(remote_folder)
+                    remote_folders.add(remote_folder)
+
+                sftp.put(local_file, remote_file, callback=get_progress_callback(pid, files_done, bytes_done),
+                         preserve_mtime=True)
+                files_done += 1
+                bytes_done += os.path.getsize(local_file)
+                publish_progress(pid, files_done=files_done, bytes_done=bytes_done)
+
+            sftp.cwd(sftp_path)
+            packages = sftp.listdir()
+
+            if pid not in packages:
+                errors.append('ERROR: Unable to upload packages to Archivematica sftp')
+    except Exception:
+        publish_progress(pid, stage='error', errors=['Unable to upload packages to Archivematica sftp'])
+        raise
+
+    if len(errors) == 0:
+        record_throughput('move_to_sftp', total_size, time.monotonic() - start)
+        publish_progress(pid, stage='upload_complete')
+        return dict(result='packages_uploaded', errors=errors)
+
+    publish_progress(pid, stage='error', errors=errors)
+
+    return dict(result='packages_not_uploaded', errors=errors)
+
+
+def get_remote_free_space(sftp):
+    """
+    Gets free space (bytes) of the Archivematica sftp remote path
+    @param: sftp
+    @returns: int (None when unknown)
+    """
+
+    try:
+        output = sftp.execute('df -Pk ' + sftp_path)
+        return int(output[-1].decode().split()[3]) * 1024
+    except Exception as e:
+        print(e)
+        print('ERROR: Unable to get free space on Archivematica sftp')
+        return None
+
+
+def record_throughput(stage, size, seconds):
+    """
+    Updates the throughput model (moving average of bytes per second) of a transfer stage
+    @param: stage
+    @param: size
+    @param: seconds
+    @returns: void
+    """
+
+    if size <= 0 or seconds <= 0:
+        return
+
+    with throughput_lock, lock_file(throughput_file):
+        model = load_json_file(throughput_file)
+        rate = size / seconds
+        previous = model.get(stage)
+
+        if previous is None:
+            model[stage] = dict(throughput=rate, samples=1)
+        else:
+            model[stage] = dict(throughput=0.7 * previous['throughput'] + 0.3 * rate,
+                                samples=previous['samples'] + 1)
+
+        save_json_file(throughput_file, model)
+
+
+@traced('preflight')
+def preflight(folder):
+    """
+    Predicts duration of transfer stages of a collection from the throughput model and checks free space
+    on 002-ingest, 003-ingested and the Archivematica sftp server
+    @param: folder
+    @returns: Dictionary
+    """
+
+    errors = []
+    warnings = []
+    space = {}
+    stages = {}
+    total_size = get_total_batch_size(folder)['result']
+
+    with throughput_lock:
+        model = load_json_file(throughput_file)
+
+    for stage in ('move_to_sftp', 'move_to_ingested'):
+
+        throughput = model.get(stage, {}).get('throughput')
+
+        if throughput is None:
+            stages[stage] = dict(throughput=None, eta_seconds=None)
+        else:
+            stages[stage] = dict(throughput=int(throughput), eta_seconds=int(total_size / throughput))
+
+    locations = [('003-ingested', shutil.disk_usage(ingested_path).free)]
+
+    # moving to 002-ingest is a rename (no space needed) when it is on the same file system
+    if os.stat(ready_path).st_dev != os.stat(ingest_path).st_dev:
+        locations.append(('002-ingest', shutil.disk_usage(ingest_path).free))
+
+    try:
+        with get_sftp_connection() as sftp:
+            locations.append(('Archivematica sftp', get_remote_free_space(sftp)))
+    except Exception as e:
+        print(e)
+        locations.append(('Archivematica sftp', None))
+
+    for name, free_space in locations:
+
+        space[name] = dict(free=free_space, required=total_size)
+
+        if free_space is None:
+            warnings.append('Unable to get free space on ' + name)
+        elif free_space < total_size:
+            errors.append('Not enough space on ' + name + ' (' + str(total_size) + ' bytes needed, ' +
+                          str(free_space) + ' bytes free)')
+        elif free_space < total_size * (1 + space_margin):
+            warnings.append('Free space on ' + name + ' is low (' + str(free_space) + ' bytes free)')
+
+    return dict(result=dict(total_batch_size=total_size, stages=stages, space=space), errors=errors, warnings=warnings)
+
+
+def get_progress_callback(uuid, files_done, bytes_done):
+    """
+    Creates an sftp transfer callback that publishes progress at most every progress_interval seconds
+    @param: uuid
+    @param: files_done
+    @param: bytes_done
+    @returns: function
+    """
+
+    last_published = [0.0]
+
+    def callback(transferred, total):
+
+        now = time.monotonic()
+
+        if now - last_published[0] >= progress_interval:
+            last_published[0] = now
+            publish_progress(uuid, files_done=files_done, bytes_done=bytes_done + transferred)
+
+    return callback
+
+
+def publish_progress(uuid, **fields):
+    """
+    Publishes progress of a batch (files_done, bytes_done, stage...) to progress listeners
+    A stage change resets the file and byte counters
+    @param: uuid
+    @param: fields
+    @returns: void
+    """
+
+    now = time.time()
+
+    with progress_condition:
+
+        state = progress.get(uuid)
+
+        if state is None or ('stage' in fields and fields['stage'] != state['stage']):
+            invalidate_sftp_status(uuid)
+            state = dict(uuid=uuid, stage=None, stage_started=now, files_done=0, bytes_done=0, throughput=0,
+                         version=0 if state is None else state['version'])
+            progress[uuid] = state
+
+        state.update(fields)
+        elapsed = now - state['stage_started']
+
+        if elapsed > 0:
+            state['throughput'] = int(state['bytes_done'] / elapsed)
+
+        state['updated'] = now
+        state['version'] += 1
+        progress_condition.notify_all()
+
+
+def get_progress_events(uuid, timeout=15):
+    """
+    Yields progress updates for a batch as they are published (None is yielded when nothing changed
+    within timeout seconds). Stops after a batch reaches a final stage, or after PROGRESS_IDLE_LIMIT timeouts
+    when nothing was ever published for the batch (unknown uuid or a restarted server)
+    @param: uuid
+    @param: timeout
+    @returns: Generator
+    """
+
+    version = -1
+    idle = 0
+
+    while True:
+
+        with progress_condition:
+            progress_condition.wait_for(lambda: uuid in progress and progress[uuid]['version'] != version, timeout)
+            state = progress.get(uuid)
+            event = None
+
+            if state is not None and state['version'] != version:
+                version = state['version']
+                event = dict(state)
+
+        yield event
+
+        if event is not None and event['stage'] in final_stages:
+            return
+
+        if state is None:
+            idle += 1
+
+            if idle >= progress_idle_limit:
+                return
+
+
+@traced('upload_status')
+def check_sftp(uuid, local_file_count=None):
+    """
+    checks upload status on archivematica sftp
+    The expected file count is taken from the stored batch state, local_file_count is only used
+    for batches without stored state
+    Remote file names are no longer collected, file_names stays in the response (empty) so its shape is unchanged
+    @param: pid
+    @param: local_file_count
+    @returns: Dictionary
+    """
+
+    batch = get_batch(uuid)
+
+    if batch is not None:
+        local_file_count = batch['total_batch_file_count']
+    elif local_file_count is None:
+        return dict(message='File count not found.', data=[])
+
+    remote_file_count, remote_package_size = get_sftp_status(uuid)
+
+    if int(local_file_count) == remote_file_count:
+        return dict(message='upload_complete', data=[[], remote_file_count])
+
+    return dict(message='in_progress', file_names=[], remote_file_count=remote_file_count,
+                local_file_count=local_file_count,
+                remote_package_size=remote_package_size)
+
+
+def get_sftp_status(uuid):
+    """
+    Gets remote file count and size of a batch on archivematica sftp
+    Concurrent callers share one in-flight query and results are reused for sftp_status_ttl seconds
+    @param: uuid
+    @returns: Tuple
+    """
+
+    with sftp_status_lock:
+
+        status = sftp_status.get(uuid)
+        is_owner = False
+
+        if status is None or (status['done'].is_set() and (
+                status['error'] is not None or time.monotonic() - status['time'] >= sftp_status_ttl)):
+            status = dict(done=threading.Event(), result=None, error=None, time=None)
+            sftp_status[uuid] = status
+            is_owner = True
+
+    if is_owner:
+        try:
+            status['result'] = get_sftp_status_remote(uuid)
+        except Exception as e:
+            status['error'] = e
+        finally:
+            status['time'] = time.monotonic()
+            status['done'].set()
+    else:
+        status['done'].wait()
+
+    if status['error'] is not None:
+        raise status['error']
+
+    return status['result']
+
+
+def get_sftp_status_remote(uuid):
+    """
+    Walks a batch on archivematica sftp (remote query for get_sftp_status)
+    Files are counted as they are walked, names are not kept
+    @param: uuid
+    @returns: Tuple
+    """
+
+    file_count = [0]
+
+    def count_file(fname):
+        file_count[0] += 1
+
+    def skip(name):
+        pass
+
+    with get_sftp_connection() as sftp:
+        remote_package = sftp_path + '/' + uuid + '/'
+        sftp.cwd(remote_package)
+        sftp.walktree(remote_package, count_file, skip, skip, recurse=True)
+
+        with sftp.cd(remote_package):
+            remote_package_size = sftp.execute('du -h -s')
+
+    return file_count[0], remote_package_size[0].decode().strip().replace('\t', '')
+
+
+def invalidate_sftp_status(uuid):
+    """
+    Removes cached sftp status of a batch (called when its upload or clean up changes state)
+    @param: uuid
+    @returns: void
+    """
+
+    with sftp_status_lock:
+        sftp_status.pop(uuid, None)
+
+
+@traced('move_to_ingested')
+def move_to_ingested(uuid, folder):
+    """
+    Moves packages to ingested folder and Wasabi S3 bucket
+    @param: pid
+    @param: folder
+    @returns: Dictionary
+    """
+
+    errors = []
+    folder_name = folder.replace('new_', '')
+    ingested = ingested_path + folder_name
+    source = ingest_path + uuid
+    result = 'packages_not_moved_to_ingested_folder'
+
+    if os.path.isdir(ingested):
+        reset_permissions(folder)
+
+    try:
+        publish_progress(uuid, stage='moving_to_ingested')
+        total_size = sum(entry.stat().st_size for entry in iter_files(source))
+        free_space = shutil.disk_usage(ingested_path).free
+
+        if free_space < total_size:
+            errors.append('ERROR: Not enough space in ingested folder (' + str(total_size) +
+                          ' bytes needed, ' + str(free_space) + ' bytes free)')
+        else:
+            start = time.monotonic()
+            transfer = transfer_to_ingested(uuid, source, ingested, folder_name)
+            errors += transfer['errors']
+
+            if len(errors) == 0:
+                record_throughput('move_to_ingested', transfer['result']['total_size'], time.monotonic() - start)
+                # the source is only deleted once wasabi s3 matches the manifest
+                verification = verify_s3(uuid, transfer['result']['manifest'])
+                errors += verification['errors']
+
+            if len(errors) == 0:
+                update_ingested_index(uuid, transfer['result']['manifest'])
+                update_hash_index(transfer['result']['manifest'])
+                shutil.rmtree(source)
+    except Exception as e:
+        print(e)
+        errors.append('ERROR: Unable to move packages to ingested folder (move_to_ingested)')
+
+    if len(errors) == 0:
+        try:
+            # TODO
+            print('delete collection file after batch is complete')
+            # deletes file
+            # os.remove('collection')
+        except Exception as e:
+            print(e)
+            print('collection file not found')
+
+        try:
+            clean_up_sftp(uuid)
+            result = 'packages_moved_to_ingested_folder'
+        except Exception as e:
+            print(e)
+            print('unable to run clean up sftp function')
+
+    if len(errors) == 0:
+        publish_progress(uuid, stage=result)
+    else:
+        publish_progress(uuid, stage='error', errors=errors)
+
+    return dict(result=result, errors=errors)
+
+
+@traced('move_to_s3')
+def transfer_to_ingested(uuid, source, ingested, folder):
+    """
+    Copies packages to the ingested folder and uploads them to Wasabi S3
+    Files at or above S3_STREAM_THRESHOLD are read once and fanned out to both destinations.
+    Smaller files are copied first and each package is then uploaded from the ingested folder by one aws cli
+    process (starting the aws cli costs more than uploading a small file), so small files are read twice
+    (the second read is usually served from the page cache). A package upload starts as soon as its copies
+    are done and runs while later packages are copied
+    @param: uuid
+    @param: source
+    @param: ingested
+    @param: folder
+    @returns: Dictionary
+    """
+
+    errors = []
+    transfers = []
+    manifest = {}
+    packages = {}
+    uploads = []
+    files_done = 0
+    total_size = 0
+
+    for dirpath, dirnames, filenames in os.walk(source):
+
+        dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+        relative_path = os.path.relpath(dirpath, source)
+        local_path = os.path.normpath(os.path.join(ingested, relative_path))
+        package = None if relative_path == '.' else relative_path.split(os.sep)[0]
+        os.makedirs(local_path, exist_ok=True)
+
+        for f in filenames:
+
+            if f.startswith('.'):
+                continue
+
+            key = os.path.normpath(os.path.join(folder, relative_path, f))
+            transfers.append((os.path.join(dirpath, f), os.path.join(local_path, f), key, package))
+            packages.setdefault(package, dict(remaining=0, streamed=[], small=[], has_small=False))['remaining'] += 1
+
+    publish_progress(uuid, total_files=len(transfers))
+
+    with ThreadPoolExecutor(max_workers=s3_upload_processes) as uploader:
+        with ThreadPoolExecutor(max_workers=io_threads) as executor:
+            for (source_file, local_file, key, package), transfer in zip(
+                    transfers, executor.map(lambda args: transfer_file(*args[:3]), transfers)):
+                errors += transfer['errors']
+                files_done += 1
+                total_size += transfer['result']
+                manifest[key] = dict(size=transfer['result'], etag=transfer['etag'], sha256=transfer['sha256'])
+                publish_progress(uuid, files_done=files_done, bytes_done=total_size)
+
+                state = packages[package]
+                state['remaining'] -= 1
+
+                if transfer['is_streamed']:
+                    state['streamed'].append(os.path.basename(local_file) if package is None else
+                                             os.path.relpath(local_file, os.path.join(ingested, package)))
+                else:
+                    state['has_small'] = True
+
+                    # files directly in source are uploaded by name, packages are uploaded as folders
+                    if package is None:
+                        state['small'].append(os.path.basename(local_file))
+
+                if state['remaining'] == 0 and state['has_small']:
+                    if package is None:
+                        uploads.append(uploader.submit(upload_to_s3, ingested, folder, state['small'], []))
+                    else:
+                        uploads.append(uploader.submit(upload_to_s3, os.path.join(ingested, package),
+                                                       folder + '/' + package, None, state['streamed']))
+
+        for upload in uploads:
+            errors += upload.result()['errors']
+
+    save_manifest(uuid, manifest)
+
+    return dict(result=dict(file_count=len(transfers), total_size=total_size, manifest=manifest), errors=errors)
+
+
+def transfer_file(source_file, local_file, key):
+    """
+    Reads a file once and writes it to the ingested folder and, for files at or above S3_STREAM_THRESHOLD,
+    to Wasabi S3 at the same time
+    A file that can not be read completely is not uploaded and its partial copy is removed
+    @param: source_file
+    @param: local_file
+    @param: key
+    @returns: Dictionary
+    """
+
+    errors = []
+    size = 0
+    sinks = []
+    threads = []
+    is_read = False
+    process = None
+    expected_size = os.path.getsize(source_file)
+    is_streamed = expected_size >= s3_stream_threshold
+    etag = get_etag_digest(expected_size)
+    digest = hashlib.sha256()
+
+    try:
+        local = open(local_file, 'wb')
+    except Exception as e:
+        print(e)
+        errors.append('ERROR: Unable to copy ' + source_file + ' to ingested folder')
+        return dict(result=size, etag=None, sha256=None, is_streamed=is_streamed, errors=errors)
+
+    destinations = [(local, 'ERROR: Unable to copy ' + source_file + ' to ingested folder')]
+
+    if is_streamed:
+        try:
+            process = move_to_s3(key, expected_size)
+        except Exception as e:
+            print(e)
+            local.close()
+            errors.append('ERROR: Unable to move ' + source_file + ' to wasabi s3')
+            return dict(result=size, etag=None, sha256=None, is_streamed=is_streamed, errors=errors)
+
+        destinations.append((process.stdin, 'ERROR: Unable to move ' + source_file + ' to wasabi s3'))
+
+    for destination, message in destinations:
+        chunks = queue.Queue(maxsize=transfer_buffer_chunks)
+        thread = threading.Thread(target=get_profiled(transfer_file_threads),
+                                  args=(chunks, destination, errors, message))
+        sinks.append(chunks)
+        threads.append(thread)
+        thread.start()
+
+    try:
+        with open(source_file, 'rb') as file:
+            while True:
+
+                with io_slot('read'):
+                    chunk = file.read(transfer_chunk_size)
+
+                if not chunk:
+                    break
+
+                size += len(chunk)
+
+                for chunks in sinks:
+                    chunks.put(chunk)
+
+                update_etag_digest(etag, chunk)
+                digest.update(chunk)
+
+        is_read = True
+    except Exception as e:
+        print(e)
+        errors.append('ERROR: Unable to read ' + source_file)
+    finally:
+        for chunks in sinks:
+            chunks.put(None)
+
+        for thread in threads:
+            thread.join()
+
+        local.close()
+
+        if process is not None:
+            # closing stdin would make the aws cli store a truncated object under the key
+            if not is_read:
+                process.kill()
+
+            try:
+                process.stdin.close()
+            except Exception as e:
+                print(e)
+
+            if process.wait() != 0 and is_read:
+                errors.append('ERROR: Unable to move ' + source_file + ' to wasabi s3')
+
+    if not is_read:
+        try:
+            os.remove(local_file)
+        except Exception as e:
+            print(e)
+
+        return dict(result=size, etag=None, sha256=None, is_streamed=is_streamed, errors=errors)
+
+    try:
+        shutil.copymode(source_file, local_file)
+    except Exception as e:
+        print(e)
+
+    return dict(result=size, etag=get_etag(etag), sha256=digest.hexdigest(), is_streamed=is_streamed, errors=errors)
+
+
+def get_etag_digest(size):
+    """
+    Creates the state used to compute the S3 ETag of a file while it is read
+    Files at or above S3_MULTIPART_THRESHOLD are uploaded by the aws cli in parts of S3_MULTIPART_CHUNKSIZE
+    (doubled until there are at most 10000 parts), their ETag is md5 of the part md5s plus the part count
+    @param: size
+    @returns: Dictionary
+    """
+
+    part_size = s3_multipart_chunksize
+
+    while (size + part_size - 1) // part_size > 10000:
+        part_size *= 2
+
+    return dict(is_multipart=size >= s3_multipart_threshold, part_size=part_size, part_bytes=0,
+                md5=hashlib.md5(), part=hashlib.md5(), parts=[])
+
+
+def update_etag_digest(etag, chunk):
+    """
+    Adds a chunk to an ETag digest
+    @param: etag
+    @param: chunk
+    @returns: void
+    """
+
+    if not etag['is_multipart']:
+        etag['md5'].update(chunk)
+        return
+
+    while len(chunk) > 0:
+
+        remaining = etag['part_size'] - etag['part_bytes']
+        etag['part'].update(chunk[:remaining])
+        etag['part_bytes'] += len(chunk[:remaining])
+        chunk = chunk[remaining:]
+
+        if etag['part_bytes'] == etag['part_size']:
+            etag['parts'].append(etag['part'].digest())
+            etag['part'] = hashlib.md5()
+            etag['part_bytes'] = 0
+
+
+def get_etag(etag):
+    """
+    Gets the S3 ETag from an ETag digest
+    @param: etag
+    @returns: string
+    """
+
+    if not etag['is_multipart']:
+        return etag['md5'].hexdigest()
+
+    parts = etag['parts']
+
+    if etag['part_bytes'] > 0:
+        parts = parts + [etag['part'].digest()]
+
+    return hashlib.md5(b''.join(parts)).hexdigest() + '-' + str(len(parts))
+
+
+def save_manifest(uuid, manifest):
+    """
+    Saves the manifest (key, size, ETag, sha256) of a transferred batch
+    @param: uuid
+    @param: manifest
+    @returns: void
+    """
+
+    os.makedirs(manifest_path, exist_ok=True)
+    save_json_file(os.path.join(manifest_path, uuid.replace('/', '_') + '.json'), manifest)
+
+
+def load_manifest(uuid):
+    """
+    Loads the manifest of a transferred batch
+    Batches transferred by workers have one manifest per package (uuid_package.json), they are merged
+    @param: uuid
+    @returns: Dictionary
+    """
+
+    name = uuid.replace('/', '_')
+    manifest = load_json_file(os.path.join(manifest_path, name + '.json'))
+
+    if len(manifest) == 0 and os.path.isdir(manifest_path):
+        for f in sorted(os.listdir(manifest_path)):
+            if f.startswith(name + '_') and f.endswith('.json'):
+                manifest.update(load_json_file(os.path.join(manifest_path, f)))
+
+    return manifest
+
+
+@traced('verify_s3')
+def verify_s3(uuid, manifest=None):
+    """
+    Verifies that every file of a batch manifest is in the Wasabi S3 bucket with the same size and ETag
+    Package prefixes are listed (ListObjectsV2) in parallel; objects that are missing or differ in
+    the listing are checked again with parallel HEAD requests
+    @param: uuid
+    @param: manifest
+    @returns: Dictionary
+    """
+
+    errors = []
+
+    if manifest is None:
+        manifest = load_manifest(uuid)
+
+    if len(manifest) == 0:
+        return dict(result='not_verified', errors=['Manifest not found'])
+
+    bucket, base_prefix = get_bucket_and_prefix()
+    prefixes = sorted(set('/'.join(key.split('/')[:2]) + '/' for key in manifest))
+    objects = {}
+
+    with ThreadPoolExecutor(max_workers=io_threads) as executor:
+        for listing in executor.map(lambda prefix: list_s3_objects(bucket, base_prefix + prefix), prefixes):
+            if listing is None:
+                errors.append('ERROR: Unable to list wasabi s3 objects')
+            else:
+                objects.update(listing)
+
+    unconfirmed = [key for key, entry in manifest.items()
+                   if objects.get(base_prefix + key) != (entry['size'], entry['etag'])]
+
+    with ThreadPoolExecutor(max_workers=io_threads) as executor:
+        for key, head in zip(unconfirmed, executor.map(lambda key: head_s3_object(bucket, base_prefix + key),
+                                                       unconfirmed)):
+            entry = manifest[key]
+
+            if head is None:
+                errors.append(key + ' is missing from wasabi s3')
+            elif head[0] != entry['size']:
+                errors.append(key + ' size does not match (' + str(head[0]) + ' != ' + str(entry['size']) + ')')
+            elif head[1] != entry['etag']:
+                errors.append(key + ' ETag does not match (' + head[1] + ' != ' + str(entry['etag']) + ')')
+
+    result = 'verified' if len(errors) == 0 else 'not_verified'
+
+    return dict(result=result, file_count=len(manifest), errors=errors)
+
+
+def get_bucket_and_prefix():
+    """
+    Splits WASABI_BUCKET (s3://bucket/prefix/) into bucket name and key prefix
+    @returns: Tuple
+    """
+
+    path = wasabi_bucket.replace('s3://', '', 1)
+    bucket, _, prefix = path.partition('/')
+
+    return bucket, prefix
+
+
+def list_s3_objects(bucket, prefix):
+    """
+    Lists objects under a prefix (paginated ListObjectsV2)
+    @param: bucket
+    @param: prefix
+    @returns: Dictionary key -> (size, ETag) (None on error)
+    """
+
+    objects = {}
+    token = None
+
+    while True:
+
+        aws_cmd = [aws_cli, 's3api', 'list-objects-v2', '--bucket', bucket, '--prefix', prefix,
+                   '--max-keys', '1000', '--no-paginate', '--output', 'json',
+                   '--endpoint-url=' + wasabi_endpoint, '--profile', wasabi_profile]
+
+        if token is not None:
+            aws_cmd += ['--continuation-token', token]
+
+        try:
+            output = subprocess.run(aws_cmd, capture_output=True, check=True).stdout
+            page = json.loads(output) if output.strip() else {}
+        except Exception as e:
+            print(e)
+            return None
+
+        for s3_object in page.get('Contents', []):
+            objects[s3_object['Key']] = (s3_object['Size'], s3_object['ETag'].strip('"'))
+
+        token = page.get('NextContinuationToken')
+
+        if token is None:
+            return objects
+
+
+def head_s3_object(bucket, key):
+    """
+    Gets size and ETag of an object (HEAD)
+    @param: bucket
+    @param: key
+    @returns: Tuple (None when the object is not found)
+    """
+
+    aws_cmd = [aws_cli, 's3api', 'head-object', '--bucket', bucket, '--key', key, '--output', 'json',
+               '--endpoint-url=' + wasabi_endpoint, '--profile', wasabi_profile]
+
+    try:
+        output = subprocess.run(aws_cmd, capture_output=True, check=True).stdout
+        head = json.loads(output)
+    except Exception as e:
+        print(e)
+        return None
+
+    return head['ContentLength'], head['ETag'].strip('"')
+
+
+def transfer_file_threads(chunks, destination, errors, message):
+    """
+    Writes chunks from a bounded queue to a destination (thread function for transfer_file)
+    The queue is drained after a failure so that the reader is never blocked
+    @param: chunks
+    @param: destination
+    @param: errors
+    @param: message
+    @returns: void
+    """
+
+    failed = False
+
+    while True:
+
+        chunk = chunks.get()
+
+        if chunk is None:
+            return
+
+        if failed:
+            continue
+
+        try:
+            destination.write(chunk)
+        except Exception as e:
+            print(e)
+            failed = True
+            errors.append(message)
+
+
+def reset_permissions(folder):
+    """
+    Resets ready folder permissions so that staff is able to add more packages
+    Only entries whose owner or group differ are changed
+    @param: folder
+    @returns: Dictionary
+    """
+
+    counts = dict(changed=0, skipped=0)
+    errors = []
+    lock = threading.Lock()
+    directories = queue.Queue()
+    threads = []
+    collection = ready_path + folder
+
+    try:
+        owner = int(uid)
+        group = int(gid)
+        stat = os.lstat(collection)
+
+        if stat.st_uid != owner or stat.st_gid != group:
+            os.lchown(collection, owner, group)
+            counts['changed'] += 1
+        else:
+            counts['skipped'] += 1
+    except Exception as e:
+        print(e)
+        errors.append('Unable to reset permissions')
+        return dict(result='Unable to reset permissions', changed=0, skipped=0, errors=errors)
+
+    directories.put(collection)
+
+    for i in range(io_threads):
+        thread = threading.Thread(target=get_profiled(reset_permissions_threads),
+                                  args=(directories, owner, group, counts, errors, lock))
+        threads.append(thread)
+        thread.start()
+
+    directories.join()
+
+    for thread in threads:
+        directories.put(None)
+
+    for thread in threads:
+        thread.join()
+
+    if len(errors) == 0:
+        message = 'Permissions changed'
     else:
-        result = 'packages_not_moved_to_ingested_folder.'
+        message = 'Unable to reset permissions'
 
-    return dict(result=result, errors=errors)
+    return dict(result=message, changed=counts['changed'], skipped=counts['skipped'], errors=errors)
 
 
-def move_to_sftp(pid):
-    """"
-    Moves folder to Archivematica sftp via ssh
-    @param: pid
+def reset_permissions_threads(directories, owner, group, counts, errors, lock):
+    """
+    Scans directories from the queue and changes ownership of entries that differ
+    (thread function for reset_permissions)
+    @param: directories
+    @param: owner
+    @param: group
+    @param: counts
+    @param: errors
+    @param: lock
     @returns: void
     """
 
-    cnopts = pysftp.CnOpts()
-    cnopts.hostkeys = None
-    errors = []
+    while True:
+
+        directory = directories.get()
+
+        if directory is None:
+            directories.task_done()
+            return
+
+        changed = 0
+        skipped = 0
+
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+
+                    with io_slot('stat'):
+                        stat = entry.stat(follow_symlinks=False)
+
+                    if stat.st_uid != owner or stat.st_gid != group:
+                        with io_slot('chown'):
+                            os.lchown(entry.path, owner, group)
+
+                        changed += 1
+                    else:
+                        skipped += 1
 
-    with pysftp.Connection(host=sftp_host, username=sftp_username, password=sftp_password, cnopts=cnopts) as sftp:
-        sftp.put_r(ingest_path, sftp_path, preserve_mtime=True)
-        packages = sftp.listdir()
+                    if entry.is_dir(follow_symlinks=False):
+                        directories.put(entry.path)
+        except Exception as e:
+            print(e)
+            with lock:
+                errors.append('Unable to reset permissions - ' + directory)
 
-        if pid not in packages:
-            errors.append(-1)
+        with lock:
+            counts['changed'] += changed
+            counts['skipped'] += skipped
 
+        directories.task_done()
 
-def check_sftp(uuid, local_file_count):
+
+def move_to_s3(key, size):
     """
-    checks upload status on archivematica sftp
-    @param: pid
-    @param: local_file_count
+    Starts a streaming upload to Wasabi S3 bucket (data is written to the process stdin)
+    @param: key
+    @param: size
+    @returns: Popen
+    """
+
+    aws_cmd = [aws_cli, 's3', 'cp', '-', wasabi_bucket + key,
+               '--endpoint-url=' + wasabi_endpoint,
+               '--profile', wasabi_profile,
+               '--expected-size', str(size)]
+
+    return subprocess.Popen(aws_cmd, stdin=subprocess.PIPE)
+
+
+def upload_to_s3(local_path, key, includes, excludes):
+    """
+    Uploads a folder to Wasabi S3 bucket with one recursive aws cli process
+    @param: local_path
+    @param: key
+    @param: includes (top level names to upload, None uploads the whole folder)
+    @param: excludes (paths relative to local_path that are not uploaded)
     @returns: Dictionary
     """
 
-    cnopts = pysftp.CnOpts()
-    cnopts.hostkeys = None
-    file_names = []
-    dir_names = []
-    un_name = []
+    errors = []
+    filters = []
 
-    def store_files_name(fname):
-        file_names.append(fname)
+    if includes is not None:
+        filters += ['--exclude', '*']
 
-    def store_dir_name(dirname):
-        dir_names.append(dirname)
+        for name in includes:
+            pattern = get_filter_pattern(name)
+            filters += ['--include', pattern + '/*' if os.path.isdir(os.path.join(local_path, name)) else pattern]
 
-    def store_other_file_types(name):
-        un_name.append(name)
+    for name in excludes:
+        filters += ['--exclude', get_filter_pattern(name)]
 
-    with pysftp.Connection(host=sftp_host, username=sftp_username, password=sftp_password, cnopts=cnopts) as sftp:
-        remote_package = sftp_path + '/' + uuid + '/'
-        sftp.cwd(remote_package)
-        sftp.walktree(remote_package, store_files_name, store_dir_name, store_other_file_types, recurse=True)
-        remote_file_count = len(file_names)
+    aws_cmd = [aws_cli, 's3', 'cp', local_path, wasabi_bucket + key, '--recursive',
+               '--endpoint-url=' + wasabi_endpoint,
+               '--profile', wasabi_profile,
+               '--only-show-errors'] + filters
+
+    try:
+        if subprocess.run(aws_cmd).returncode != 0:
+            errors.append('ERROR: Unable to move ' + local_path + ' to wasabi s3')
+    except Exception as e:
+        print(e)
+        errors.append('ERROR: Unable to move ' + local_path + ' to wasabi s3')
+
+    return dict(result=local_path, errors=errors)
 
-        with sftp.cd(remote_package):
-            remote_package_size = sftp.execute('du -h -s')
 
-        if int(local_file_count) == remote_file_count:
-            return dict(message='upload_complete', data=[file_names, remote_file_count])
+def get_filter_pattern(name):
+    """
+    Escapes wildcard characters of a path for aws cli --include/--exclude filters
+    @param: name
+    @returns: string
+    """
 
-        return dict(message='in_progress', file_names=file_names, remote_file_count=remote_file_count,
-                    local_file_count=local_file_count,
-                    remote_package_size=remote_package_size[0].decode().strip().replace('\t', ''))
+    return re.sub(r'([*?\[])', r'[\1]', name)
 
 
-def move_to_ingested(uuid, folder):
+@traced('clean_up_sftp')
+def clean_up_sftp(pid):
     """
-    Moves packages to ingested folder and Wasabi S3 bucket
-    @param: pid
+    Deletes collection folder from ingest folder and sftp server
+    :param pid
+    :param folder
+    :return void
+    """
+
+    try:
+        with get_sftp_connection() as sftp:
+            sftp.cwd(sftp_path)
+            sftp.execute('rm -R ' + pid)
+    finally:
+        invalidate_sftp_status(pid)
+
+
+def enqueue_package_tasks(folder, task, uuid=None):
+    """
+    Adds a task for every package in a collection to the shared job queue
     @param: folder
+    @param: task
+    @param: uuid
     @returns: Dictionary
     """
 
     errors = []
-    ingested = ingested_path + folder.replace('new_', '')
-    exists = os.path.isdir(ingested)
-    result = 'packages_not_moved_to_ingested_folder'
+    jobs = {}
 
-    if exists:
-
-        reset_permissions(folder)
+    if task not in ('check_file_names', 'hash_package', 'transfer_package'):
+        return dict(result=jobs, errors=['Unknown task - ' + task])
 
-        try:  # move only files because collection folder already exists
-            file_names = [f for f in os.listdir(ingest_path + uuid) if not f.startswith('.')]
+    if task == 'transfer_package':
+        packages = [f for f in os.listdir(ingest_path + uuid) if not f.startswith('.')]
+    else:
+        packages = [f for f in os.listdir(ready_path + folder) if not f.startswith('.')]
 
-            for file_name in file_names:
-                os.system('cp -R ' + os.path.join(ingest_path + uuid, file_name) + ' ' + ingested)
+    # the batch is recorded first, a worker may finish a task before the last one is queued
+    if task == 'transfer_package' and len(packages) > 0:
+        create_batch_tasks(uuid, folder, packages)
 
-            source = ingest_path + uuid + '/'
-            move_result = move_to_s3(source, folder.replace('new_', ''))
-            if move_result == 1:
-                errors.append('ERROR: Unable to move packages to wasabi s3')
-            else:
-                shutil.rmtree(source)
+    for package in packages:
+        try:
+            jobs[package] = enqueue_task(task, dict(folder=folder, package=package, uuid=uuid))
         except Exception as e:
             print(e)
-            return errors.append('ERROR: Unable to move files to ingested folder (move_to_ingested)')
+            errors.append('Unable to queue ' + task + ' for ' + package)
 
-    else:  # move entire folder
+            if task == 'transfer_package':
+                update_batch_package(uuid, package, None, ['Unable to queue ' + task + ' for ' + package])
 
-        try:
-            shutil.move(ingest_path + uuid, ingest_path + folder.replace('new_', ''))
-            os.system('cp -R ' + ingest_path + folder.replace('new_', '') + ' ' + ingested)
-            source = ingest_path
-            move_result = move_to_s3(source, '')
-            if move_result == 1:
-                errors.append('ERROR: Unable to move packages to wasabi s3')
-            else:
-                shutil.rmtree(ingest_path + folder.replace('new_', ''))
+    return dict(result=jobs, errors=errors)
 
-        except Exception as e:
-            print(e)
-            return errors.append('ERROR: Unable to move folder (move_to_ingested)')
+
+def create_batch_tasks(uuid, folder, packages):
+    """
+    Records the packages of a batch transferred by workers in the queue (the worker finishing the last package
+    finishes the batch) and watches the batch for progress listeners of this process
+    @param: uuid
+    @param: folder
+    @param: packages
+    @returns: void
+    """
+
+    create_queue_folders()
+    path = os.path.join(queue_path, 'batches', uuid + '.json')
+
+    with lock_file(path):
+        save_json_file(path, dict(uuid=uuid, folder=folder, packages=packages, finished={}, queued=time.time()))
+
+    publish_progress(uuid, stage='moving_to_ingested', total_packages=len(packages), packages_done=0)
+    threading.Thread(target=watch_batch_threads, args=(uuid,), daemon=True).start()
+
+
+def update_batch_tasks(task, result, errors):
+    """
+    Records a finished transfer task of a batch (called by workers)
+    @param: task
+    @param: result
+    @param: errors
+    @returns: void
+    """
+
+    if task['task'] == 'transfer_package':
+        update_batch_package(task['args']['uuid'], task['args']['package'], result, errors)
+
+
+def update_batch_package(uuid, package, result, errors):
+    """
+    Records a finished package of a batch transferred by workers and finishes the batch after its last package
+    @param: uuid
+    @param: package
+    @param: result
+    @param: errors
+    @returns: void
+    """
+
+    path = os.path.join(queue_path, 'batches', uuid + '.json')
+
+    with lock_file(path):
+
+        batch = load_json_file(path)
+
+        if len(batch) == 0 or 'completed' in batch:
+            return
+
+        total_size = result['total_size'] if isinstance(result, dict) and 'total_size' in result else 0
+        batch['finished'][package] = dict(errors=errors, total_size=total_size)
+
+        if len(batch['finished']) == len(batch['packages']):
+            finish_batch(batch)
+
+        save_json_file(path, batch)
+
+
+def finish_batch(batch):
+    """
+    Finishes a batch transferred by workers (same final steps as move_to_ingested)
+    @param: batch
+    @returns: void
+    """
+
+    errors = [error for finished in batch['finished'].values() for error in finished['errors']]
+    result = 'packages_not_moved_to_ingested_folder'
 
     if len(errors) == 0:
-        try:
-            # TODO
-            print('delete collection file after batch is complete')
-            # deletes file
-            # os.remove('collection')
-        except Exception as e:
-            print(e)
-            print('collection file not found')
+        record_throughput('move_to_ingested', sum(finished['total_size'] for finished in batch['finished'].values()),
+                          time.time() - batch['queued'])
 
         try:
-            clean_up_sftp(uuid)
+            clean_up_sftp(batch['uuid'])
             result = 'packages_moved_to_ingested_folder'
         except Exception as e:
             print(e)
             print('unable to run clean up sftp function')
 
-    return dict(result=result, errors=errors)
+    batch.update(result=result, errors=errors, completed=time.time())
 
 
-def reset_permissions(folder):
+def watch_batch_threads(uuid):
     """
-    Resets ready folder permissions so that staff is able to add more packages
-    @param: folder
-    :returns: void
+    Publishes progress of a batch transferred by workers until it is finished
+    (thread function for create_batch_tasks and resume_batch_watchers)
+    @param: uuid
+    @returns: void
     """
 
-    message = 'Permissions changed'
+    path = os.path.join(queue_path, 'batches', uuid + '.json')
+    packages_done = -1
 
-    try:
-        cmd = 'chown -R ' + uid + ':' + gid + ' ' + ready_path + folder
-        os.system(cmd)
-    except Exception as e:
-        print(e)
-        message = 'Unable to reset permissions'
+    while True:
+
+        batch = load_json_file(path)
+
+        if len(batch) == 0:
+            return
+
+        if 'completed' in batch:
+            invalidate_sftp_status(uuid)
+
+            if len(batch['errors']) == 0:
+                publish_progress(uuid, stage=batch['result'])
+            else:
+                publish_progress(uuid, stage='error', errors=batch['errors'])
+
+            return
 
-    return message
+        if len(batch['finished']) != packages_done:
+            packages_done = len(batch['finished'])
+            publish_progress(uuid, stage='moving_to_ingested', total_packages=len(batch['packages']),
+                             packages_done=packages_done)
 
+        time.sleep(batch_watch_interval)
 
-def move_to_s3(source, folder):
+
+def resume_batch_watchers():
     """
-    Moves packages to Wasabi S3 bucket
-    @param: source
-    @param: folder
+    Watches batches that were still being transferred by workers when this process started
+    @returns: int
+    """
+
+    count = 0
+
+    if not queue_path or not os.path.isdir(os.path.join(queue_path, 'batches')):
+        return count
+
+    for name in os.listdir(os.path.join(queue_path, 'batches')):
+        if name.endswith('.json') and 'completed' not in load_json_file(os.path.join(queue_path, 'batches', name)):
+            threading.Thread(target=watch_batch_threads, args=(name[:-len('.json')],), daemon=True).start()
+            count += 1
+
+    return count
+
+
+def enqueue_task(task, args):
+    """
+    Adds a task to the shared job queue (QUEUE_PATH)
+    Tasks are written to a temporary file first so that workers never see partial files
+    @param: task
+    @param: args
+    @returns: string
+    """
+
+    create_queue_folders()
+
+    job = os.urandom(16).hex()
+    name = format(time.time_ns(), '020d') + '-' + job + '.json'
+    tmp_file = os.path.join(queue_path, 'tmp', name)
+
+    with open(tmp_file, 'w') as task_file:
+        json.dump(dict(job=job, task=task, args=args, queued=time.time()), task_file)
+
+    os.rename(tmp_file, os.path.join(queue_path, 'pending', name))
+
+    return job
+
+
+def create_queue_folders():
+    """
+    Creates the job queue folders
     @returns: void
     """
 
-    errors = []
-    aws_exec = '/usr/local/bin/aws s3 cp'
-    aws_endpoint = '--endpoint-url=' + wasabi_endpoint
-    aws_bucket = wasabi_bucket
-    aws_args = '--recursive --profile ' + wasabi_profile
-    result = 1
+    for state in queue_states + ('tmp', 'batches'):
+        os.makedirs(os.path.join(queue_path, state), exist_ok=True)
+
+
+def claim_task(worker):
+    """
+    Claims the oldest pending task. The claim is an atomic rename into the claimed folder,
+    so only one worker (on any node sharing QUEUE_PATH) gets each task
+    Every claim gets its own file name (task name plus a claim token), so a worker whose claim was requeued
+    can not complete or renew another worker's claim of the same task
+    @param: worker
+    @returns: Tuple
+    """
+
+    pending = os.path.join(queue_path, 'pending')
+    claimed = os.path.join(queue_path, 'claimed')
+
+    for name in sorted(os.listdir(pending)):
+
+        claim = name[:-len('.json')] + '.' + os.urandom(4).hex() + '.json'
 
-    if folder != '':
         try:
-            aws_cmd = aws_exec + ' ' + source + ' ' + aws_endpoint + ' ' + aws_bucket + folder + ' ' + aws_args
-            result = os.system(aws_cmd)
-        except Exception as e:
-            print(e)
-            errors.append('error')
-    else:
+            os.rename(os.path.join(pending, name), os.path.join(claimed, claim))
+        except FileNotFoundError:
+            continue
+
+        # mtime of a claimed task is its last heartbeat (see task_heartbeat and requeue_stale_tasks)
+        os.utime(os.path.join(claimed, claim))
+
+        with open(os.path.join(claimed, claim)) as task_file:
+            task = json.load(task_file)
+
+        task['worker'] = worker
+        task['claimed'] = time.time()
+        task['claim'] = claim
+
+        return claim, task
+
+    return None, None
+
+
+def get_task_name(claim):
+    """
+    Gets the queue file name of a task from its claim file name
+    @param: claim
+    @returns: string
+    """
+
+    return claim.split('.')[0] + '.json'
+
+
+def is_task_claimed(claim):
+    """
+    Checks that a claim is still held (it is gone once the task was requeued)
+    @param: claim
+    @returns: Boolean
+    """
+
+    return os.path.exists(os.path.join(queue_path, 'claimed', claim))
+
+
+@contextmanager
+def task_heartbeat(claim):
+    """
+    Renews a claim every QUEUE_HEARTBEAT_INTERVAL seconds while its task runs,
+    so that long tasks are not requeued after QUEUE_CLAIM_TIMEOUT
+    @param: claim
+    @returns: Context manager
+    """
+
+    stop = threading.Event()
+    thread = threading.Thread(target=task_heartbeat_threads, args=(claim, stop), daemon=True)
+    thread.start()
+
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def task_heartbeat_threads(claim, stop):
+    """
+    Touches a claimed task until stop is set (thread function for task_heartbeat)
+    @param: claim
+    @param: stop
+    @returns: void
+    """
+
+    while not stop.wait(queue_heartbeat_interval):
         try:
-            aws_cmd = aws_exec + ' ' + source + ' ' + aws_endpoint + ' ' + aws_bucket + ' ' + aws_args
-            result = os.system(aws_cmd)
+            os.utime(os.path.join(queue_path, 'claimed', claim))
+        except FileNotFoundError:
+            print('ERROR: Claim lost - ' + claim)
+            return
         except Exception as e:
             print(e)
-            errors.append('error')
 
-    return result
 
+def complete_task(name, task, result, errors):
+    """
+    Saves the result of a claimed task to the done (or failed) folder
+    Nothing is saved when the claim is no longer held (the task was requeued and belongs to another worker)
+    @param: name (claim)
+    @param: task
+    @param: result
+    @param: errors
+    @returns: Boolean
+    """
 
-def clean_up_sftp(pid):
+    state = 'done' if len(errors) == 0 else 'failed'
+    task.update(result=result, errors=errors, completed=time.time())
+    claim_file = os.path.join(queue_path, 'tmp', name)
+    tmp_file = os.path.join(queue_path, 'tmp', get_task_name(name))
+
+    # taking the claim file away first makes completing and requeueing exclusive
+    try:
+        os.rename(os.path.join(queue_path, 'claimed', name), claim_file)
+    except FileNotFoundError:
+        print('ERROR: Claim lost, result not saved - ' + name)
+        return False
+
+    with open(tmp_file, 'w') as task_file:
+        json.dump(task, task_file)
+
+    os.rename(tmp_file, os.path.join(queue_path, state, get_task_name(name)))
+    os.remove(claim_file)
+
+    return True
+
+
+def requeue_stale_tasks():
     """
-    Deletes collection folder from ingest folder and sftp server
-    :param pid
-    :param folder
-    :return void
+    Moves tasks without a heartbeat for QUEUE_CLAIM_TIMEOUT seconds (e.g. claimed by a worker that died)
+    back to pending
+    @returns: int
     """
 
-    host = os.getenv('SFTP_HOST')
-    username = os.getenv('SFTP_ID')
-    password = os.getenv('SFTP_PWD')
-    cnopts = pysftp.CnOpts()
-    cnopts.hostkeys = None
-    sftp_path = os.getenv('SFTP_REMOTE_PATH')
+    claimed = os.path.join(queue_path, 'claimed')
+    count = 0
+
+    for name in os.listdir(claimed):
+        try:
+            if time.time() - os.path.getmtime(os.path.join(claimed, name)) > queue_claim_timeout:
+                os.rename(os.path.join(claimed, name), os.path.join(queue_path, 'pending', get_task_name(name)))
+                count += 1
+        except FileNotFoundError:
+            continue
+
+    return count
+
+
+def get_task_status(job):
+    """
+    Gets state and result of a queued task
+    @param: job
+    @returns: Dictionary
+    """
+
+    for state in queue_states:
+
+        path = os.path.join(queue_path, state)
+
+        if not os.path.isdir(path):
+            continue
+
+        for name in os.listdir(path):
+            if name.split('.')[0].endswith('-' + job):
+                try:
+                    with open(os.path.join(path, name)) as task_file:
+                        task = json.load(task_file)
+                except FileNotFoundError:  # moved to another state while reading
+                    return get_task_status(job)
+
+                task['state'] = state
+                return dict(result=task, errors=[])
+
+    return dict(result=None, errors=['Task not found'])
+
+
+def run_task(task):
+    """
+    Runs a claimed per-package task
+    @param: task
+    @returns: Dictionary
+    """
+
+    args = task['args']
+    folder = args['folder']
+    package = args['package']
+
+    if task['task'] == 'check_file_names':
+        file_count, renames, errors = check_file_names_threads(folder, package, False)
+        return dict(result=dict(file_count=file_count, renames=renames), errors=errors)
+
+    if task['task'] == 'hash_package':
+        package_path = ready_path + folder + '/' + package
+        hashes = {}
+
+        # stat before hashing so that a file changed while it is hashed does not match its cache entry
+        for entry in iter_files(package_path):
+            stat = entry.stat()
+            hashes[os.path.relpath(entry.path, package_path)] = [stat.st_size, stat.st_mtime_ns, hash_file(entry.path)]
+
+        update_ready_hashes(folder, package, hashes)
+        errors = ['Unable to hash ' + package + '/' + f for f, entry in hashes.items() if entry[2] is None]
+        return dict(result=dict((f, entry[2]) for f, entry in hashes.items()), errors=errors)
+
+    if task['task'] == 'transfer_package':
+        folder_name = folder.replace('new_', '')
+        source = ingest_path + args['uuid'] + '/' + package
+        transfer = transfer_to_ingested(args['uuid'] + '/' + package, source,
+                                        ingested_path + folder_name + '/' + package, folder_name + '/' + package)
+
+        if len(transfer['errors']) == 0:
+            transfer['errors'] += verify_s3(args['uuid'] + '/' + package, transfer['result']['manifest'])['errors']
+
+        # the source must not be removed under a worker that was given this task after a lost claim
+        if len(transfer['errors']) == 0 and not is_task_claimed(task['claim']):
+            transfer['errors'].append('Claim lost, ' + source + ' was not removed')
+
+        if len(transfer['errors']) == 0:
+            update_ingested_index(args['uuid'], transfer['result']['manifest'])
+            update_hash_index(transfer['result']['manifest'])
+            shutil.rmtree(source)
+
+        return transfer
 
-    with pysftp.Connection(host=host, username=username, password=password, cnopts=cnopts) as sftp:
-        sftp.cwd(sftp_path)
-        sftp.execute('rm -R ' + pid)
+    return dict(result=None, errors=['Unknown task - ' + task['task']])
@@ -0,0 +1,79 @@
+import os
+import socket
+import threading
+import time
+
+import qa_lib
+
+poll_interval = float(os.getenv('QUEUE_POLL_INTERVAL', '5'))
+worker_threads = int(os.getenv('WORKER_THREADS', str(qa_lib.io_threads)))
+worker = socket.gethostname() + ':' + str(os.getpid())
+
+
+def run_worker():
+    """
+    Starts worker threads that claim and run tasks from the shared job queue (QUEUE_PATH)
+    Any number of workers can run on one host or on several hosts sharing QUEUE_PATH
+    @returns: void
+    """
+
+    threads = []
+
+    # state written by workers is read by the api host, it has to be on storage all nodes share
+    for name, path in (('INGESTED_INDEX_FILE', qa_lib.ingested_index_file), ('HASH_INDEX_FILE', qa_lib.hash_index_file),
+                       ('READY_HASH_FILE', qa_lib.ready_hash_file), ('THROUGHPUT_FILE', qa_lib.throughput_file),
+                       ('MANIFEST_PATH', qa_lib.manifest_path)):
+        if not os.path.isabs(path):
+            raise SystemExit('ERROR: ' + name + ' must be an absolute path on shared storage - ' + path)
+
+    qa_lib.create_queue_folders()
+
+    for i in range(worker_threads):
+        thread = threading.Thread(target=run_worker_threads, args=(worker + ':' + str(i),))
+        threads.append(thread)
+        thread.start()
+
+    print('Worker ' + worker + ' started with ' + str(worker_threads) + ' threads')
+
+    for thread in threads:
+        thread.join()
+
+
+def run_worker_threads(worker_id):
+    """
+    Claims and runs tasks until the process is stopped (thread function for run_worker)
+    @param: worker_id
+    @returns: void
+    """
+
+    while True:
+
+        try:
+            qa_lib.requeue_stale_tasks()
+            name, task = qa_lib.claim_task(worker_id)
+        except Exception as e:
+            print(e)
+            print('ERROR: Unable to claim task')
+            name = None
+
+        if name is None:
+            time.sleep(poll_interval)
+            continue
+
+        try:
+            with qa_lib.task_heartbeat(name):
+                results = qa_lib.run_task(task)
+        except Exception as e:
+            print(e)
+            results = dict(result=None, errors=['Unable to run ' + task['task']])
+
+        try:
+            if qa_lib.complete_task(name, task, results['result'], results['errors']):
+                qa_lib.update_batch_tasks(task, results['result'], results['errors'])
+        except Exception as e:
+            print(e)
+            print('ERROR: Unable to complete task - ' + name)
+
+
+if __name__ == '__main__':
+    run_worker()
@@ -1,3 +1,3 @@
 # Start with root user
 # nohup sh start_prod.sh &
-waitress-serve --call 'qa:app'
\ No newline at end of file
+python3 qa.py
\ No newline at end of file
@@ -0,0 +1,3 @@
+# Start a qa worker (any number of hosts can share QUEUE_PATH)
+# nohup sh start_worker.sh &
+python3 qa_worker.py
\ No newline at end of file